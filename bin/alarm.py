@@ -8,21 +8,50 @@
 # ---------------------------------------------------------------
 
 import os
+import sys
 import time
 import json
+import signal
 import tempfile
 import traceback
 import subprocess
 from datetime import datetime
 
-from modem import list_modem, list_sms, read_sms, send_sms, delete_sms
-from utility import debug
-from upsplus import input_voltage, battery_percentage
-from sendmail import send_mail_with_auth
+# Before loading the other modules, see ready_seconds
+started = time.monotonic()
+
+from modem import list_modem, list_sms, read_sms, delete_sms
+from utility import debug, sd_notify
+from upsplus import ups_telemetry
+from battery import battery_monitor
+from mailqueue import queue_mail, MailSender
+from motionevents import MotionCollector
+from events import ModemWatcher
+from commands import Command, handle_command, COMMANDS
+from dispatcher import Dispatcher
+from modems import ModemPool
+from smsqueue import SmsQueue, URGENT, STATUS
+from smsjournal import sms_journal, sms_keys
+from storage import media_catalog, StorageManager
+from metrics import MetricsExporter, modem_seconds, modem_errors, command_seconds, sms_delay_seconds, loop_seconds, ready_seconds, first_command_seconds
 
 import config
 
-HELP_MSG="RPI4 Alarm available commands: STOP, RESTART, POWEROFF, REBOOT, MOTION [STOP|START|RESTART], BATTERY, PHOTO, VIDEO [s], HELP"
+# "poll" lists the SMS every SLEEP_TIME seconds, "event" waits for the
+# ModemManager signals and polls only every SWEEP_TIME seconds
+RECEIVE_MODE = getattr(config, "RECEIVE_MODE", "poll")
+SWEEP_TIME = getattr(config, "SWEEP_TIME", 60)
+
+# "motion" uses only the motion daemon, "detector" and "auto" the
+# built-in detector too (see detector.py)
+MOTION_MODE = getattr(config, "MOTION_MODE", "motion")
+
+# Snapshot of the state to restore after a restart: the battery alerts
+# already sent, the modems and the SMS not sent yet
+STATE_FILE = getattr(config, "STATE_FILE", os.path.join(config.LOG_PATH, "alarm-state.json"))
+# A start within STARTUP_QUIET_TIME seconds of the last one announced is
+# not announced, e.g. in a crash loop
+STARTUP_QUIET_TIME = getattr(config, "STARTUP_QUIET_TIME", 600)
 
 # Patch tempfile:
 class _HexRandomNameSequence(tempfile._RandomNameSequence):
@@ -30,164 +59,286 @@ class _HexRandomNameSequence(tempfile._RandomNameSequence):
 
 tempfile._name_sequence = _HexRandomNameSequence()
 
-# Create the log directory if it does not exists
-os.makedirs(config.LOG_PATH, exist_ok=True)
+def run_deferred(deferred: list):
+    # Let the replies go out before a restart or a reboot
+    sms_queue.flush(60)
+    result = subprocess.run(deferred)
+    debug("arg:\n%s\nout:\n%s\nerr:\n%s\n" % (result.args, result.stdout, result.stderr))
 
-# Initial starting message
-debug("Starting RPI4 Alarm")
-send_mail_with_auth("Alarm status", "Starting RPI4 Alarm")
-modem_list, modem_error = list_modem()
-while not modem_list:
-    if modem_error != 0:
-        debug("Error %d and no modem found" % modem_error)
-        send_mail_with_auth("Alarm error", "Error %d and no modem found" % modem_error)
-        raise Exception("Error %d and no modem found" % modem_error)
-    time.sleep(config.SLEEP_TIME)
-    modem_list, modem_error = list_modem()
-
-debug("At least one modem found:\n%s" % "\n".join(modem_list))
-send_mail_with_auth("Alarm status", "At least one modem found:\n\n%s\n" % "\n".join(modem_list))
-for modem in modem_list:
-    debug("Found modem " + modem)
-    sms_list, sms_error = list_sms(modem)
-    if len(sms_list) > 0:
-        debug("Found %s pending messages" % len(sms_list))
-    sent, ret = send_sms(modem, "Starting RPI4 Alarm with %d pending commands" % len(sms_list), config.TRUSTED_PHONE)
-    debug("Sent initial message: %s, %s" % (sent, ret))
-
-LASTBP=0
-
-# Main loop
-while True:
-    modem_list, modem_error = list_modem()
-    if not modem_list or modem_error != 0:
-        send_mail_with_auth("Alarm error", "Error %d reading modem list.\n\nModem list:\n\n%s\n" % (modem_error, modem_list))
-    # FIXME: Cosa fare se un modem si scollega?
-    for modem in modem_list:
-        sms_list, sms_error = list_sms(modem)
-        for sms in sms_list:
+def handle_sms(worker, sms: str, sms_body: dict):
+    # Returns the deferred command, if any
+    sms_sender = sms_body.get("content", {}).get("number", "")
+    sms_text = sms_body.get("content", {}).get("text", "")
+    debug("Message received on %s from %s, text length %d" % (worker.modem, sms_sender, len(sms_text)))
+    if sms_sender == config.TRUSTED_PHONE:
+        command = Command(worker.modem, sms_sender, sms_text, sms_queue.send)
+        with command_seconds.time(command=command.name if command.name in COMMANDS else "INVALID"):
+            deferred = handle_command(command, dispatcher)
+        if first_command_seconds.count() == 0:
+            first_command_seconds.observe(time.monotonic() - started)
+        return deferred
+    log_fd, log_name = tempfile.mkstemp(suffix=".json", prefix="invalid-sms-", dir=config.LOG_PATH)
+    err_msg = "Warning: Invalid from %s, text logged in %s!" % (sms_sender, log_name)
+    sent, ret = sms_queue.send(err_msg, config.TRUSTED_PHONE, URGENT)
+    with os.fdopen(log_fd, 'w') as f:
+        f.write(json.dumps(sms_body, indent=4))
+    media_catalog().add(log_name, "invalid-sms")
+
+def process_modem(worker):
+    # Runs in the worker thread of the modem: read all the SMS, handle the
+    # new ones in order, then delete them all and run the deferred commands
+    sms_list, sms_error = worker.call(list_sms)
+    if sms_error == 0 and worker.modem in announce:
+        # Behind the replies, merged with them if possible
+        announce.discard(worker.modem)
+        sms_queue.send("Starting RPI4 Alarm with %d pending commands" % len(sms_list), config.TRUSTED_PHONE, STATUS)
+    worker.pending &= set(sms_list)
+    batch = []
+    for sms in sms_list:
+        if sms in worker.pending:
+            # Already handled, only the delete failed
+            continue
+        sms_body, read_error = worker.call(read_sms, sms)
+        if read_error != 0:
+            continue
+        if sms_body.get("properties", {}).get("state", "") == "receiving":
+            # Multipart SMS not completed yet, try again soon: in event mode
+            # the next sweep may be SWEEP_TIME away
+            debug("Message %s still receiving" % sms)
+            worker.retry(config.SLEEP_TIME)
+            continue
+        batch.append((sms_body.get("properties", {}).get("timestamp", ""), sms, sms_body))
+
+    journal = sms_journal()
+    deferred_list = []
+    for timestamp, sms, sms_body in sorted(batch, key=lambda b: b[0]):
+        key, content = sms_keys(sms_body)
+        try:
+            sent = datetime.fromisoformat(timestamp).timestamp()
+        except ValueError:
+            sent = None
+        # Recorded before running: after a restart it is not run again
+        skip = journal.claim(key, content, sent)
+        if skip == "duplicate":
+            # Not run, but not silently
+            text = sms_body.get("content", {}).get("text", "")
+            sms_queue.send("Ignored duplicate from %s: %s" % (sms_body.get("content", {}).get("number", ""), text),
+                           config.TRUSTED_PHONE, URGENT)
+        if skip is not None:
+            debug("Message %s skipped: %s" % (sms, skip))
+        else:
+            if sent is not None:
+                # Time spent in the network and waiting for this pass
+                sms_delay_seconds.observe(time.time() - sent)
             try:
-                sms_body, read_error = read_sms(modem, sms)
-                sms_sender = sms_body.get("content", {}).get("number", "")
-                sms_text = sms_body.get("content", {}).get("text", "")
-                deferred = None
-                debug("Message received from %s, text length %d" % (sms_sender, len(sms_text)))
-                if sms_sender == config.TRUSTED_PHONE:
-                    sms_split = sms_text.split(" ")
-                    sms_split.append("")
-                    sms_command = sms_split[0].upper()
-                    debug("Command %s received from %s" % (sms_command, sms_sender))
-                    match sms_command:
-                        # case "STOP":
-                        #     sent, ret = send_sms(modem, "Shutting down RPI4 Alarm service", config.TRUSTED_PHONE)
-                        #     debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                        #     deferred = ['systemctl', 'stop', 'rpi4-alarm']
-                        case "RESTART":
-                            sent, ret = send_sms(modem, "Restarting RPI4 Alarm service", config.TRUSTED_PHONE)
-                            debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                            deferred = ['systemctl', 'restart', 'rpi4-alarm']
-                        # case "POWEROFF":
-                        #     sent, ret = send_sms(modem, "Shutting down RPI4 Alarm host", config.TRUSTED_PHONE)
-                        #     debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                        #     deferred = ['poweroff']
-                        case "REBOOT":
-                            sent, ret = send_sms(modem, "Restarting RPI4 Alarm host", config.TRUSTED_PHONE)
-                            debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                            deferred = ['reboot']
-                        case "MOTION":
-                            match sms_split[1].upper():
-                                case "STOP":
-                                    sent, ret = send_sms(modem, "Stopping motion detection", config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                                    deferred = ['systemctl', 'stop', 'motion']
-                                case "START":
-                                    sent, ret = send_sms(modem, "Starting motion detection", config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                                    deferred = ['systemctl', 'start', 'motion']
-                                case "RESTART":
-                                    sent, ret = send_sms(modem, "Restarting motion detection", config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                                    deferred = ['systemctl', 'restart', 'motion']
-                                case "STATUS":
-                                    result = subprocess.run(['systemctl', 'status', 'motion'])
-                                    sent, ret = send_sms(modem, "Motion detection status %d" % result.returncode, config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                                case _:
-                                    sent, ret = send_sms(modem, "Invalid command: " + sms_text, config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                        case "BATTERY":
-                            bp, _ = battery_percentage()
-                            iv, _ = input_voltage()
-                            cc = ("charging voltage %.2fv" % (iv/1000)) if iv>3000 else "not charging"
-                            sent, ret = send_sms(modem, "Battery status %d%%, %s" % (bp, cc), config.TRUSTED_PHONE)
-                            debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                        case "PHOTO":
-                            # apt install fswebcam
-                            photo_fd, photo_name = tempfile.mkstemp(suffix=".jpg", prefix="photo-", dir=config.LOG_PATH)
-                            os.close(photo_fd)
-                            os.remove(photo_name)
-                            active_motion = subprocess.run(['systemctl', 'status', 'motion']).returncode == 0
-                            if active_motion:
-                                sent, ret = send_sms(modem, "Can't take photo while motion is running", config.TRUSTED_PHONE)
-                                debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                            else:
-                                result = subprocess.run(["fswebcam", "--no-banner", "-d", config.VIDEO_DEVICE, "-r", "1920x1080", photo_name])
-                                if result.returncode == 0:
-                                    photo_sub = "Photo taken on %s saved in %s" % (datetime.now().strftime("%Y/%m/%d, %H:%M:%S"), photo_name)
-                                    send_mail_with_auth("Alarm photo", photo_sub, photo_name)
-                                    sent, ret = send_sms(modem, photo_sub, config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                                else:
-                                    sent, ret = send_sms(modem, "Error %d taking photo" % result.returncode, config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                        case "VIDEO":
-                            video_fd, video_name = tempfile.mkstemp(suffix=".mkv", prefix="video-", dir=config.LOG_PATH)
-                            os.close(video_fd)
-                            os.remove(video_name)
-                            active_motion = subprocess.run(['systemctl', 'status', 'motion']).returncode == 0
-                            if active_motion:
-                                sent, ret = send_sms(modem, "Can't record a video while motion is running", config.TRUSTED_PHONE)
-                                debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                            else:
-                                video_time = int(sms_split[1]) if sms_split[1] != "" and sms_split[1].isdigit() else 3
-                                result = subprocess.run(["ffmpeg", "-t", "%d" % video_time, "-f", "v4l2", "-framerate", "30", "-video_size", "800x600", "-i", config.VIDEO_DEVICE, "-pix_fmt", "yuv420p", video_name])
-                                if result.returncode == 0:
-                                    video_sub = "Video recorded on %s for %ds in %s" % (datetime.now().strftime("%Y/%m/%d, %H:%M:%S"), video_time, video_name)
-                                    send_mail_with_auth("Alarm video", video_sub, video_name)
-                                    sent, ret = send_sms(modem, video_sub, config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                                else:
-                                    sent, ret = send_sms(modem, "Error %d recording video" % result.returncode, config.TRUSTED_PHONE)
-                                    debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                        case "HELP":
-                            sent, ret = send_sms(modem, HELP_MSG, config.TRUSTED_PHONE)
-                            debug("Reply to %s sent to %s: %s, %s" % (sms_command, config.TRUSTED_PHONE, sent, ret))
-                        case _:
-                            sent, ret = send_sms(modem, "Invalid command: " + sms_text, config.TRUSTED_PHONE)
-                            debug("Reply to INVALID sent to %s: %s, %s" % (config.TRUSTED_PHONE, sent, ret))
-                else:
-                    log_fd, log_name = tempfile.mkstemp(suffix=".json", prefix="invalid-sms-", dir=config.LOG_PATH)
-                    err_msg = "Warning: Invalid from %s, text logged in %s!" % (sms_sender, log_name)
-                    sent, ret = send_sms(modem, err_msg, config.TRUSTED_PHONE)
-                    with os.fdopen(log_fd, 'w') as f:
-                        f.write(json.dumps(sms_body, indent=4))
+                deferred = handle_sms(worker, sms, sms_body)
+                if deferred is not None:
+                    deferred_list.append(deferred)
             except:
                 debug(traceback.format_exc())
-            # Remove the sms
-            deleted, ret = delete_sms(modem, sms)
-            debug("Deleted message %s: %s, %s" % (sms, sent, ret))
-            if not deleted:
-                debug("Error deleting %s: deferred command \"%s\" not executed!" % (sms, " ".join(deferred)))
-            elif deferred is not None:
-                result = subprocess.run(deferred)
-                debug("arg:\n%s\nout:\n%s\nerr:\n%s\n" % (result.args, result.stdout, result.stderr))
-        # Test battery percentage change
-        bp, ret = battery_percentage()
-        if ret == 0 and bp < 100 and bp != LASTBP:
-            iv, _ = input_voltage()
-            cc = ("charging voltage %.2fv" % (iv/1000)) if iv>3000 else "not charging"
-            sent, ret = send_sms(modem, "Battery status %d%%, %s" % (bp, cc), config.TRUSTED_PHONE)
+        worker.pending.add(sms)
+
+    # Remove all the sms handled, also the ones of the previous passes
+    for sms in sorted(worker.pending):
+        deleted, ret = worker.call(delete_sms, sms)
+        debug("Deleted message %s: %s, %s" % (sms, deleted, ret))
+        if deleted:
+            worker.pending.discard(sms)
+    for deferred in deferred_list:
+        dispatcher.submit("system", run_deferred, deferred)
+
+def load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def boot_id():
+    # Without a RTC the clock can go back after a reboot, tell boots apart
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+saved_state = None
+
+def write_state(state: dict):
+    # Only when changed, it is called at every loop
+    global saved_state
+    data = json.dumps(state)
+    if data == saved_state:
+        return
+    with open(STATE_FILE + ".tmp", "w") as f:
+        f.write(data)
+    os.replace(STATE_FILE + ".tmp", STATE_FILE)
+    saved_state = data
+
+def save_state():
+    write_state({
+        "boot": boot,
+        "announced": announced,
+        "restarts": restarts,
+        "modems": pool.modems(),
+        "battery": battery_monitor().snapshot(),
+        "sms": sms_queue.snapshot(),
+    })
+
+def timed_list_modem():
+    # list_modem() counted in the modem call metrics, like ModemPool.call
+    with modem_seconds.time(call="list_modem"):
+        modem_list, modem_error = list_modem()
+    if modem_error != 0:
+        modem_errors.inc(call="list_modem")
+    return modem_list, modem_error
+
+# Set by start()
+dispatcher = None
+watcher = None
+pool = None
+sms_queue = None
+boot = ""
+announced = 0
+restarts = 0
+# Modems whose first pass sends the starting SMS
+announce = set()
+
+def start():
+    # Get ready to handle the commands as soon as possible: the modems and
+    # the SMS not sent come from the last snapshot, the notifications and
+    # the other services go in the background. Returns the modem list
+    global dispatcher, watcher, pool, sms_queue, boot, announced, restarts
+
+    # Create the log directory if it does not exists
+    os.makedirs(config.LOG_PATH, exist_ok=True)
+    state = load_state()
+    battery_monitor().restore(state.get("battery", {}))
+    boot, announced, restarts = boot_id(), state.get("announced", 0), state.get("restarts", 0)
+
+    # Not announced if restarted within STARTUP_QUIET_TIME on this boot,
+    # e.g. in a crash loop
+    quiet = state.get("boot") == boot and 0 <= time.time() - announced < STARTUP_QUIET_TIME
+    note = ""
+    if quiet:
+        restarts += 1
+    else:
+        if restarts:
+            note = " (%d restarts not announced since %s)" % (restarts, datetime.fromtimestamp(announced).strftime("%Y/%m/%d, %H:%M:%S"))
+        announced, restarts = time.time(), 0
+
+    # The modems of the last run, checked by the first main loop pass
+    modem_list = state.get("modems", [])
+    if not modem_list:
+        modem_list, modem_error = timed_list_modem()
+        if modem_error != 0 and not modem_list:
+            debug("Error %d and no modem found" % modem_error)
+            if not quiet:
+                queue_mail("Alarm error", "Error %d and no modem found%s" % (modem_error, note))
+            # Counted like any other start
+            write_state(dict(state, boot=boot, announced=announced, restarts=restarts))
+            raise Exception("Error %d and no modem found" % modem_error)
+
+    dispatcher = Dispatcher()
+
+    if RECEIVE_MODE == "event":
+        watcher = ModemWatcher()
+        watcher.start()
+
+    pool = ModemPool(process_modem, SWEEP_TIME if watcher is not None else config.SLEEP_TIME)
+    # The replies and the alerts are queued, merged and rate limited
+    sms_queue = SmsQueue(pool)
+    sms_queue.restore(state.get("sms", []))
+    sms_queue.start()
+
+    # Initial starting message
+    debug("Starting RPI4 Alarm with modems:\n%s" % "\n".join(modem_list))
+    if not quiet:
+        queue_mail("Alarm status", "Starting RPI4 Alarm%s\n\nModem list:\n\n%s\n" % (note, "\n".join(modem_list)))
+        announce.update(modem_list)
+    pool.update(modem_list)
+    save_state()
+    ready_seconds.observe(time.monotonic() - started)
+    sd_notify("READY=1\nSTATUS=%d modems" % len(modem_list))
+
+    # Deliver the mail queued by us and by the motion hooks
+    MailSender().start()
+
+    # Counters and timings, see STATS
+    MetricsExporter().start()
+
+    # Keep the media within their quotas
+    StorageManager(media_catalog()).start()
+
+    # Coalesce the motion events in digest mails
+    MotionCollector(dispatcher=dispatcher).start()
+    return modem_list
+
+def check(modem_state: tuple):
+    # One pass of the main loop: the modems are handled by their workers,
+    # here only look for modems added or removed and check the battery.
+    # Returns the new modem state, (error, count)
+    loop_start = time.monotonic()
+    modem_list, modem_error = timed_list_modem()
+    if modem_error == 0:
+        added, removed = pool.update(modem_list)
+        if added or removed:
+            queue_mail("Alarm status", "Modems added:\n\n%s\n\nModems removed:\n\n%s\n\nModem list:\n\n%s\n" % (
+                "\n".join(added), "\n".join(removed), "\n".join(modem_list)))
+    if (modem_error, len(modem_list)) != modem_state and (modem_error != 0 or not modem_list):
+        queue_mail("Alarm error", "Error %d reading modem list.\n\nModem list:\n\n%s\n" % (modem_error, modem_list))
+    # Report only the meaningful battery changes
+    telemetry, ret = ups_telemetry()
+    if ret == 0:
+        for key, alert in battery_monitor().update(telemetry):
+            sent, ret = sms_queue.send(alert, config.TRUSTED_PHONE, URGENT, key)
             debug("Auto send to %s: %s, %s" % (config.TRUSTED_PHONE, sent, ret))
-            LASTBP = bp
-    # All done, sleep
-    time.sleep(config.SLEEP_TIME)
+    if MOTION_MODE != "motion":
+        # On battery the built-in detector replaces motion
+        from detector import motion_switch
+        message = motion_switch().update(battery_monitor().on_mains)
+        if message is not None:
+            queue_mail("Alarm status", message)
+    save_state()
+    loop_seconds.observe(time.monotonic() - loop_start)
+    return modem_error, len(modem_list)
+
+def main():
+    modem_state = (0, len(start()))
+    try:
+        while True:
+            modem_state = check(modem_state)
+            # All done, sleep
+            if watcher is not None:
+                events = watcher.wait(SWEEP_TIME)
+                debug("Woken up by %d modem events" % len(events))
+                for member, path, args in events:
+                    if member == "Added":
+                        pool.wake(path)
+                    elif member == "MonitorLost":
+                        pool.wake()
+                if not watcher.alive:
+                    # Back to polling every SLEEP_TIME, the workers too
+                    pool.wake()
+            else:
+                time.sleep(config.SLEEP_TIME)
+    finally:
+        sd_notify("STOPPING=1")
+        save_state()
+
+if __name__ == "__main__":
+    # Save the state when stopped by systemd
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        main()
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    # The state is saved, exit without joining the dispatcher workers: a
+    # RESTART job waits for this very stop, a VIDEO job for its capture
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
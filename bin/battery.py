@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : battery.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Battery telemetry history and alerts.
+#
+# The UPS readings are stored in a fixed size ring buffer, a memory mapped
+# file in LOG_PATH, so the history survives restarts and never grows. The
+# monitor only reports the meaningful transitions: mains lost or restored,
+# a threshold crossed (with hysteresis) and a predicted shutdown, computed
+# from the discharge rate of the last BATTERY_RATE_WINDOW seconds.
+
+import os
+import mmap
+import struct
+import threading
+
+from utility import *
+
+BATTERY_HISTORY = getattr(config, "BATTERY_HISTORY", os.path.join(config.LOG_PATH, "battery.dat"))
+BATTERY_HISTORY_SIZE = getattr(config, "BATTERY_HISTORY_SIZE", 2880)
+BATTERY_SAMPLE_TIME = getattr(config, "BATTERY_SAMPLE_TIME", 30)
+BATTERY_THRESHOLDS = getattr(config, "BATTERY_THRESHOLDS", [50, 25, 10])
+BATTERY_HYSTERESIS = getattr(config, "BATTERY_HYSTERESIS", 3)
+BATTERY_RATE_WINDOW = getattr(config, "BATTERY_RATE_WINDOW", 1800)
+BATTERY_SHUTDOWN_WARNING = getattr(config, "BATTERY_SHUTDOWN_WARNING", 1200)
+# Input voltage (mV) above MAINS_ON is mains power, below MAINS_OFF is not
+MAINS_ON = getattr(config, "MAINS_ON", 4500)
+MAINS_OFF = getattr(config, "MAINS_OFF", 3000)
+
+# magic, capacity, next record, records
+HEADER = struct.Struct("<4sIII")
+# time, percentage, input mV, battery mV, current mA
+RECORD = struct.Struct("<dhhhh")
+MAGIC = b"BAT1"
+
+class BatteryHistory:
+    def __init__(self, path: str = BATTERY_HISTORY, capacity: int = BATTERY_HISTORY_SIZE):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        size = HEADER.size + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            new = os.fstat(fd).st_size != size
+            if new:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, stored, self.head, self.count = HEADER.unpack_from(self.map, 0)
+        if new or magic != MAGIC or stored != capacity or self.head >= capacity:
+            self.head, self.count = 0, 0
+            self._header()
+
+    def _header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.capacity, self.head, self.count)
+
+    def append(self, now: float, percentage: int, input_voltage: int, battery_voltage: int, current: float):
+        with self.lock:
+            RECORD.pack_into(self.map, HEADER.size + self.head * RECORD.size,
+                             now, percentage, min(input_voltage, 32767), min(battery_voltage, 32767),
+                             max(-32768, min(int(current), 32767)))
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self._header()
+
+    def samples(self, since: float = 0):
+        # Oldest first
+        with self.lock:
+            first = (self.head - self.count) % self.capacity
+            records = [RECORD.unpack_from(self.map, HEADER.size + ((first + i) % self.capacity) * RECORD.size)
+                       for i in range(self.count)]
+        return [r for r in records if r[0] >= since]
+
+    def last(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            return RECORD.unpack_from(self.map, HEADER.size + ((self.head - 1) % self.capacity) * RECORD.size)
+
+    def close(self):
+        self.map.close()
+
+def discharge_rate(samples: list):
+    # Least squares slope of the percentage, in % per hour lost
+    if len(samples) < 2 or samples[-1][0] - samples[0][0] < 300:
+        return None
+    n = len(samples)
+    mt = sum(s[0] for s in samples) / n
+    mp = sum(s[1] for s in samples) / n
+    var = sum((s[0] - mt) ** 2 for s in samples)
+    if var == 0:
+        return None
+    slope = sum((s[0] - mt) * (s[1] - mp) for s in samples) / var
+    return -slope * 3600
+
+def format_duration(seconds: float):
+    minutes = int(seconds // 60)
+    return "%dh%02dm" % (minutes // 60, minutes % 60) if minutes >= 60 else "%dm" % minutes
+
+class BatteryMonitor:
+    def __init__(self, history: BatteryHistory):
+        self.history = history
+        self.on_mains = None
+        self.discharging_since = None
+        self.level = 0
+        self.shutdown_warned = False
+        self.percentage = 0
+        self.input_voltage = 0
+        self.recorded = 0
+        self.now = 0
+        self.lock = threading.RLock()
+
+    def remaining(self):
+        # Estimated seconds of battery left, None while on mains or unknown
+        if self.on_mains is not False:
+            return None
+        now = self.now
+        rate = discharge_rate(self.history.samples(max(now - BATTERY_RATE_WINDOW, self.discharging_since or 0)))
+        if rate is None or rate <= 0:
+            return None
+        return self.percentage / rate * 3600
+
+    def status(self):
+        cc = ("charging voltage %.2fv" % (self.input_voltage/1000)) if self.input_voltage>3000 else "not charging"
+        text = "Battery status %d%%, %s" % (self.percentage, cc)
+        remaining = self.remaining()
+        if remaining is not None:
+            text += ", about %s left" % format_duration(remaining)
+        return text
+
+    # Alert state saved across restarts: no "Mains power lost" or threshold
+    # alert again for what was already reported
+    STATE = ("on_mains", "discharging_since", "level", "shutdown_warned")
+
+    def snapshot(self):
+        with self.lock:
+            return {name: getattr(self, name) for name in self.STATE}
+
+    def restore(self, state: dict):
+        with self.lock:
+            for name in self.STATE:
+                if name in state:
+                    setattr(self, name, state[name])
+
+    def update(self, telemetry):
+        # Returns the list of (key, alert) to send, the SmsQueue key: the
+        # newer mains or battery alert replaces the one still queued
+        with self.lock:
+            return self._update(telemetry)
+
+    def _update(self, telemetry):
+        now = self.now = telemetry.time
+        self.percentage = telemetry.battery_percentage
+        self.input_voltage = telemetry.usbc_voltage
+        if now - self.recorded >= BATTERY_SAMPLE_TIME:
+            self.history.append(now, telemetry.battery_percentage, telemetry.usbc_voltage,
+                                telemetry.battery_voltage, telemetry.battery_current)
+            self.recorded = now
+
+        alerts = []
+        on_mains = self.on_mains
+        if self.input_voltage > MAINS_ON:
+            on_mains = True
+        elif self.input_voltage < MAINS_OFF:
+            on_mains = False
+        if on_mains != self.on_mains:
+            previous, self.on_mains = self.on_mains, on_mains
+            if on_mains:
+                if previous is not None:
+                    alerts.append(("mains", "Mains power restored, " + self.status()))
+                self.discharging_since = None
+                self.shutdown_warned = False
+            else:
+                self.discharging_since = now
+                alerts.append(("mains", "Mains power lost, " + self.status()))
+
+        # Thresholds: alert when going below, re-arm above threshold + hysteresis
+        level = self.level
+        while level < len(BATTERY_THRESHOLDS) and self.percentage < BATTERY_THRESHOLDS[level]:
+            level += 1
+        while level > 0 and self.percentage >= BATTERY_THRESHOLDS[level - 1] + BATTERY_HYSTERESIS:
+            level -= 1
+        if level > self.level and not on_mains:
+            alerts.append(("battery", "Battery below %d%%, %s" % (BATTERY_THRESHOLDS[level - 1], self.status())))
+        self.level = level
+
+        remaining = self.remaining()
+        if remaining is not None and remaining < BATTERY_SHUTDOWN_WARNING and not self.shutdown_warned:
+            alerts.append(("battery", "Shutdown expected in %s, %s" % (format_duration(remaining), self.status())))
+            self.shutdown_warned = True
+        return alerts
+
+_monitor = None
+
+def battery_monitor():
+    global _monitor
+    if _monitor is None:
+        _monitor = BatteryMonitor(BatteryHistory())
+    return _monitor
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : benchmark.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+'''
+Benchmarks, runnable off-device against the stand-ins in fakes.py.
+
+    benchmark.py mail [MB ...]    peak RSS sending attachments of MB megabytes
+    benchmark.py sms              SMS sent, parts and latency of a burst of
+                                  replies, sent directly and through the queue
+    benchmark.py detector [CLIP ...]
+                                  frames per second and CPU of the built-in
+                                  motion detector on .mjpeg clips
+    benchmark.py startup          alarm.py time to ready (systemd notify) and
+                                  to the first command handled, without and
+                                  with a state snapshot
+    benchmark.py alarm            alarm.py fed SMS commands at a given rate
+                                  by a fake mmcli, with a discharging fake
+                                  UPS, a synthetic camera and an SMTP sink:
+                                  throughput, latency per command, process
+                                  spawns and peak memory; --receive-mode
+                                  event replays the SMS as ModemManager
+                                  signals through a fake monitor
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import socket
+import signal
+import resource
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+
+def peak_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def mail_child(args):
+    # Runs in its own process, so ru_maxrss only accounts for one send
+    import sendmail
+    sendmail.SMTP_HOST, sendmail.SMTP_PORT, sendmail.SMTP_SSL = "127.0.0.1", args.port, False
+    sendmail.config.EMAIL_PASSWORD = ""
+    before = peak_rss()
+    start = time.time()
+    with sendmail.smtp_connect() as server:
+        sendmail.send_message(server, "Benchmark", "Benchmark attachment", args.attachment)
+    print(json.dumps({"elapsed": time.time() - start, "rss_before": before, "rss_peak": peak_rss()}))
+
+def bench_mail(args):
+    from fakes import SMTPSink
+    sink = SMTPSink().start()
+    print("%8s %10s %12s %12s %10s" % ("size MB", "time s", "RSS base MB", "RSS peak MB", "MB/s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            attachment = os.path.join(tmp, "attachment-%d.mkv" % size)
+            with open(attachment, "wb") as f:
+                block = os.urandom(1024 * 1024)
+                for _ in range(size):
+                    f.write(block)
+            result = subprocess.run([sys.executable, __file__, "mail-child", "--port", str(sink.port), attachment],
+                                    stdout=subprocess.PIPE, check=True)
+            stats = json.loads(result.stdout.splitlines()[-1])
+            print("%8d %10.2f %12.1f %12.1f %10.1f" % (size, stats["elapsed"], stats["rss_before"] / 1024,
+                                                      stats["rss_peak"] / 1024, size / stats["elapsed"]))
+            os.remove(attachment)
+    sink.stop()
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+def sms_burst(count: int):
+    # Replies to a burst of commands, with a battery status every 5
+    burst = []
+    for i in range(count):
+        if i % 5 == 4:
+            burst.append(("Battery %d%%, on battery, about 2h left" % (90 - i), 2, "battery"))
+        else:
+            burst.append(("Reply %d: Motion detection status 0" % i, 1, None))
+    return burst
+
+def bench_sms(args):
+    import smsqueue
+    from fakes import FakeModem
+    from modems import ModemPool
+    smsqueue.SMS_RATE, smsqueue.SMS_BURST = args.rate, args.burst
+    smsqueue.SMS_COALESCE_TIME = args.coalesce
+    burst = sms_burst(args.messages)
+    print("%8s %10s %6s %6s %10s %10s" % ("mode", "time s", "SMS", "parts", "p50 s", "p95 s"))
+
+    # Direct: every reply is an SMS, sent while the command is handled
+    fake = FakeModem(args.latency)
+    pool = ModemPool(lambda worker: None, 3600)
+    pool.update(["/fake/Modem/%d" % i for i in range(args.modems)])
+    start = time.time()
+    latency = []
+    for text, priority, key in burst:
+        pool.ranked()[0].call(fake.send_sms, text, "+0000")
+        latency.append(time.time() - start)
+    elapsed = time.time() - start
+    parts = sum(smsqueue.sms_parts(text) for _, _, text in fake.sent)
+    print("%8s %10.2f %6d %6d %10.2f %10.2f" % ("direct", elapsed, len(fake.sent), parts,
+                                               percentile(latency, 50), percentile(latency, 95)))
+
+    # Queue: merged per number, the last battery status replaces the others
+    fake = FakeModem(args.latency)
+    queue = smsqueue.SmsQueue(pool, fake.send_sms)
+    queue.start()
+    start = time.time()
+    for text, priority, key in burst:
+        queue.send(text, "+0000", priority, key)
+    queue.flush(3600)
+    elapsed = time.time() - start
+    queue.stop()
+    pool.update([])
+    parts = sum(smsqueue.sms_parts(text) for _, _, text in fake.sent)
+    print("%8s %10.2f %6d %6d %10.2f %10.2f" % ("queue", elapsed, len(fake.sent), parts,
+                                               percentile(queue.latency, 50), percentile(queue.latency, 95)))
+
+def bench_detector(args):
+    import detector
+    from camera import split_jpeg
+    from fakes import synthetic_clip
+    with tempfile.TemporaryDirectory() as tmp:
+        clips = args.clips or [synthetic_clip(os.path.join(tmp, "synthetic.mjpeg"))]
+        print("%-24s %7s %7s %9s %9s %12s" % ("clip", "frames", "motion", "decode/s", "frames/s", "CPU %% @%gfps" % args.fps))
+        for clip in clips:
+            with open(clip, "rb") as f:
+                frames = split_jpeg(bytearray(f.read()))
+            motion = detector.MotionDetector()
+            start = time.process_time()
+            decoded = [detector.decode(jpeg, args.width) for jpeg in frames]
+            decode_time = time.process_time() - start
+            moving = 0
+            for frame in decoded:
+                score, fraction = motion.feed(frame)
+                moving += score >= detector.DETECTOR_MIN_BLOCKS
+            cpu = time.process_time() - start
+            print("%-24s %7d %7d %9.1f %9.1f %12.1f" % (os.path.basename(clip)[:24], len(frames), moving,
+                                                       len(frames) / decode_time, len(frames) / cpu,
+                                                       100 * args.fps * cpu / len(frames)))
+
+BENCH_CONFIG = """
+EMAIL_SENDER = "alarm@localhost"
+EMAIL_ADDRESS = "owner@localhost"
+EMAIL_PASSWORD = ""
+SMTP_HOST = "127.0.0.1"
+SMTP_PORT = %(smtp_port)d
+SMTP_SSL = False
+TRUSTED_PHONE = "+000000000000"
+SLEEP_TIME = %(poll)g
+VIDEO_DEVICE = "/dev/null"
+LOG_PATH = %(log_path)r
+DEBUG = False
+MAIL_POLL_TIME = 1
+SMS_RATE = %(sms_rate)g
+SMS_DUPLICATE_WINDOW = 0
+CAMERA_SHM = %(camera_shm)r
+CAMERA_FPS = 5
+STORAGE_QUOTAS = {LOG_PATH: (10 * 1024 ** 3, 30)}
+METRICS_INTERVAL = 3600
+UPS_REFRESH = 0.5
+BATTERY_SAMPLE_TIME = 1
+"""
+
+def write_config(directory: str, smtp_port: int, poll: float = 0.2, sms_rate: float = 600, monitor: list = None):
+    # config.py for alarm.py in directory, the logs in directory/log; with
+    # a monitor command the SMS are received in "event" mode
+    log_path = os.path.join(directory, "log")
+    os.makedirs(log_path, exist_ok=True)
+    with open(os.path.join(directory, "config.py"), "w") as f:
+        f.write(BENCH_CONFIG % {
+            "smtp_port": smtp_port, "poll": poll, "log_path": log_path, "sms_rate": sms_rate,
+            "camera_shm": "rpi4-alarm-bench-%d" % os.getpid(),
+        })
+        if monitor is not None:
+            f.write('RECEIVE_MODE = "event"\nMODEM_MONITOR_CMD = %r\n' % monitor)
+    return log_path
+
+def alarm_child(args):
+    # Runs in its own process: alarm.py reads the generated config and the
+    # spawn counts and the peak memory are only its own
+    from fakes import SMTPSink, FakeModemManager, FakeI2CBus, synthetic_clip, write_mjpeg
+    sink = SMTPSink().start()
+    mm = FakeModemManager(args.directory, args.modems, args.latency, args.failure).install()
+    write_config(args.directory, sink.port, args.poll, args.sms_rate,
+                 mm.monitor_command() if args.receive_mode == "event" else None)
+    sys.path.insert(0, args.directory)
+
+    spawns = Counter()
+    popen_init = subprocess.Popen.__init__
+    def counting_init(self, command, *popen_args, **popen_kwargs):
+        spawns[os.path.basename(command[0] if isinstance(command, (list, tuple)) else command.split()[0])] += 1
+        popen_init(self, command, *popen_args, **popen_kwargs)
+    subprocess.Popen.__init__ = counting_init
+
+    # The synthetic video device
+    import camera
+    try:
+        clip = synthetic_clip(os.path.join(args.directory, "camera.mjpeg"), 30, (640, 360), (10, 20))
+    except ImportError:
+        clip = write_mjpeg(os.path.join(args.directory, "camera.mjpeg"))
+    daemon = camera.CameraDaemon(clip).start()
+
+    # The UPS: mains lost after a third of the run, nearly empty at the end
+    import upsplus
+    duration = args.messages / args.rate
+    upsplus.sampler = upsplus.UPSSampler(FakeI2CBus([(0, 100, True), (duration / 3, 100, False), (duration, 5, False)]))
+
+    import alarm
+    import config
+    thread = threading.Thread(target=alarm.main, name="alarm", daemon=True)
+    thread.start()
+    while alarm.sms_queue is None:
+        if not thread.is_alive():
+            sys.exit("alarm.py failed to start")
+        time.sleep(0.01)
+    rss_started = peak_rss()
+
+    commands = args.commands.split(",")
+    received = {}
+    start = time.time()
+    for i in range(args.messages):
+        time.sleep(max(0, start + i / args.rate - time.time()))
+        if random.random() < args.invalid:
+            text, number = "INVALID", "+111111111111"
+        else:
+            text, number = commands[i % len(commands)], config.TRUSTED_PHONE
+        sms = mm.receive(text, number, i % args.modems)
+        received[(str(i % args.modems), sms)] = (text.split(" ")[0].upper(), time.time())
+
+    # Done when every SMS has been deleted
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        deleted = {(c["modem"], c["sms"]) for c in mm.calls() if c["call"] == "delete_sms" and c["returncode"] == 0}
+        if deleted >= received.keys():
+            break
+        time.sleep(0.1)
+    elapsed = time.time() - start
+    alarm.sms_queue.flush(args.flush)
+    daemon.stop()
+    if alarm.watcher is not None:
+        alarm.watcher.stop()
+
+    from smstext import sms_parts
+    calls = mm.calls()
+    sent = [c["text"] for c in calls if c["call"] == "create_sms" and c["returncode"] == 0]
+    handled = {}
+    for c in calls:
+        key = (c["modem"], c["sms"])
+        if c["call"] == "delete_sms" and c["returncode"] == 0 and key in received and key not in handled:
+            name, when = received[key]
+            handled[key] = (name, c["time"] - when)
+    print(json.dumps({
+        "messages": len(received),
+        "elapsed": elapsed,
+        "latency": list(handled.values()),
+        "calls": Counter("%s%s" % (c["call"], "" if c["returncode"] == 0 else " failed") for c in calls),
+        "sms_sent": len(sent),
+        "sms_parts": sum(sms_parts(text) for text in sent),
+        "sms_pending": alarm.sms_queue.pending(),
+        "spawns": spawns,
+        "mail": sink.received,
+        "rss_started": rss_started,
+        "rss_peak": peak_rss(),
+        "rss_children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }))
+    sys.stdout.flush()
+    # The alarm threads never end
+    os._exit(0)
+
+def alarm_main(args):
+    # alarm.py run as systemd would, on a UPS on mains power
+    import runpy
+    import upsplus
+    from fakes import FakeI2CBus
+    upsplus.sampler = upsplus.UPSSampler(FakeI2CBus())
+    runpy.run_path(os.path.join(os.path.dirname(__file__), "alarm.py"), run_name="__main__")
+
+def kill_session(session: int):
+    # The mmcli still running when the alarm exits would outlive it and
+    # write to a directory removed meanwhile
+    try:
+        os.killpg(session, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def bench_alarm(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        child = [sys.executable, __file__, "alarm-child", "--directory", tmp]
+        for name in ("messages", "rate", "modems", "latency", "failure", "invalid", "poll", "sms_rate", "timeout", "flush", "receive_mode"):
+            child += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+        process = subprocess.Popen(child + ["--commands", args.commands], stdout=subprocess.PIPE, start_new_session=True)
+        output = process.communicate()[0]
+        kill_session(process.pid)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, child)
+    stats = json.loads(output.splitlines()[-1])
+    latency = {}
+    for name, seconds in stats["latency"]:
+        latency.setdefault(name, []).append(seconds)
+    print("%d SMS at %g/s on %d modems (%s mode), %d handled in %.1fs: %.1f SMS/s" % (
+        stats["messages"], args.rate, args.modems, args.receive_mode, len(stats["latency"]), stats["elapsed"],
+        len(stats["latency"]) / stats["elapsed"]))
+    print()
+    print("%-10s %6s %8s %8s %8s %8s" % ("command", "count", "p50 s", "p95 s", "p99 s", "max s"))
+    for name, values in sorted(latency.items()) + [("all", [s for _, s in stats["latency"]])]:
+        print("%-10s %6d %8.2f %8.2f %8.2f %8.2f" % (name, len(values), percentile(values, 50),
+                                                   percentile(values, 95), percentile(values, 99), max(values)))
+    print()
+    print("Replies: %d SMS, %d parts, %d pending; %d mails" % (
+        stats["sms_sent"], stats["sms_parts"], stats["sms_pending"], stats["mail"]))
+    print("mmcli calls: " + ", ".join("%s %d" % item for item in sorted(stats["calls"].items())))
+    print("Processes spawned: " + ", ".join("%s %d" % item for item in sorted(stats["spawns"].items())))
+    print("Peak RSS: %.1f MB after startup, %.1f MB at the end, %.1f MB largest child" % (
+        stats["rss_started"] / 1024, stats["rss_peak"] / 1024, stats["rss_children"] / 1024))
+
+def bench_startup(args):
+    # alarm.py started as systemd would, with a command waiting in the
+    # inbox: the first time without a state snapshot, then restarted
+    from fakes import SMTPSink, FakeModemManager
+    sink = SMTPSink().start()
+    with tempfile.TemporaryDirectory() as tmp:
+        mm = FakeModemManager(tmp, args.modems, args.latency).install()
+        log_path = write_config(tmp, sink.port)
+        notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        notify.bind(os.path.join(tmp, "notify"))
+        env = dict(os.environ, PYTHONPATH=tmp, NOTIFY_SOCKET=os.path.join(tmp, "notify"))
+        print("%-8s %8s %10s %13s" % ("run", "ready s", "handled s", "mmcli calls"))
+        for run in range(args.runs):
+            sms = mm.receive("HELP", "+000000000000")
+            start = time.time()
+            process = subprocess.Popen([sys.executable, __file__, "alarm-main"],
+                                       env=env, stdout=subprocess.DEVNULL, start_new_session=True)
+            notify.settimeout(args.timeout)
+            try:
+                while b"READY=1" not in notify.recv(4096):
+                    pass
+                ready = time.time() - start
+            except socket.timeout:
+                ready = float("nan")
+            handled = float("nan")
+            deadline = start + args.timeout
+            while time.time() < deadline:
+                deletes = [c for c in mm.calls() if c["call"] == "delete_sms" and c["sms"] == sms and c["returncode"] == 0]
+                if deletes:
+                    handled = deletes[0]["time"] - start
+                    break
+                time.sleep(0.01)
+            calls = sum(1 for c in mm.calls() if start <= c["time"] <= start + handled)
+            process.terminate()
+            process.wait()
+            kill_session(process.pid)
+            print("%-8s %8.2f %10.2f %13d" % ("cold" if run == 0 else "restart", ready, handled, calls))
+    sink.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="RPI4 Alarm benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    mail = commands.add_parser("mail", help="peak memory sending large attachments")
+    mail.add_argument("sizes", type=int, nargs="*", default=[10, 100, 500], help="attachment sizes in MB")
+    mail.set_defaults(function=bench_mail)
+
+    sms = commands.add_parser("sms", help="SMS sent for a burst of replies, direct and queued")
+    sms.add_argument("--messages", type=int, default=20, help="replies in the burst")
+    sms.add_argument("--latency", type=float, default=0.5, help="fake modem seconds per part")
+    sms.add_argument("--modems", type=int, default=1)
+    sms.add_argument("--rate", type=float, default=6, help="parts per minute per modem")
+    sms.add_argument("--burst", type=int, default=4, help="token bucket size")
+    sms.add_argument("--coalesce", type=float, default=1, help="seconds to wait for more replies")
+    sms.set_defaults(function=bench_sms)
+
+    detector = commands.add_parser("detector", help="built-in motion detector throughput")
+    detector.add_argument("clips", nargs="*", help=".mjpeg clips, a synthetic one by default")
+    detector.add_argument("--width", type=int, default=160, help="detector frame width")
+    detector.add_argument("--fps", type=float, default=2, help="detector frame rate for the CPU estimate")
+    detector.set_defaults(function=bench_detector)
+
+    alarm = commands.add_parser("alarm", help="alarm.py command flow at high SMS rates against fake hardware")
+    alarm.add_argument("--messages", type=int, default=200, help="SMS received")
+    alarm.add_argument("--rate", type=float, default=10, help="SMS received per second")
+    alarm.add_argument("--modems", type=int, default=1)
+    alarm.add_argument("--latency", type=float, default=0, help="fake mmcli seconds per call")
+    alarm.add_argument("--failure", type=float, default=0, help="fake mmcli probability of failure")
+    alarm.add_argument("--invalid", type=float, default=0.05, help="fraction of SMS from an unknown number")
+    alarm.add_argument("--poll", type=float, default=0.2, help="SLEEP_TIME of the alarm")
+    alarm.add_argument("--sms-rate", type=float, default=600, help="SMS_RATE of the alarm")
+    alarm.add_argument("--receive-mode", choices=("poll", "event"), default="poll",
+                       help="RECEIVE_MODE of the alarm, event uses the fake monitor")
+    alarm.add_argument("--commands", default="HELP,BATTERY,STATS,PHOTO,LAST PHOTO", help="comma separated commands sent in turn")
+    alarm.add_argument("--timeout", type=float, default=120, help="seconds to wait for the SMS to be handled")
+    alarm.add_argument("--flush", type=float, default=10, help="seconds to wait for the replies to be sent")
+    alarm.set_defaults(function=bench_alarm)
+
+    startup = commands.add_parser("startup", help="alarm.py time to ready and to the first command, cold and restarted")
+    startup.add_argument("--runs", type=int, default=3, help="starts, the first without a state snapshot")
+    startup.add_argument("--modems", type=int, default=1)
+    startup.add_argument("--latency", type=float, default=0, help="fake mmcli seconds per call")
+    startup.add_argument("--timeout", type=float, default=30, help="seconds to wait for each start")
+    startup.set_defaults(function=bench_startup)
+
+    alarm_child_parser = commands.add_parser("alarm-child")
+    alarm_child_parser.add_argument("--directory", required=True)
+    for name, kind in (("messages", int), ("rate", float), ("modems", int), ("latency", float), ("failure", float),
+                       ("invalid", float), ("poll", float), ("sms-rate", float), ("timeout", float), ("flush", float),
+                       ("receive-mode", str)):
+        alarm_child_parser.add_argument("--" + name, type=kind, required=True)
+    alarm_child_parser.add_argument("--commands", required=True)
+    alarm_child_parser.set_defaults(function=alarm_child)
+
+    alarm_main_parser = commands.add_parser("alarm-main")
+    alarm_main_parser.set_defaults(function=alarm_main)
+
+    child = commands.add_parser("mail-child")
+    child.add_argument("--port", type=int, required=True)
+    child.add_argument("attachment")
+    child.set_defaults(function=mail_child)
+
+    args = parser.parse_args()
+    args.function(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : camera.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+'''
+Camera capture daemon (see rpi4-alarm-camera.service):
+
+    camera.py [SOURCE]
+
+It owns the camera and keeps the last CAMERA_BUFFER seconds of JPEG
+frames in a shared memory ring buffer, so a photo is a copy of the newest
+frame, a video can start CAMERA_PREROLL seconds in the past and the
+motion detection reads the same frames without opening the device.
+
+It is started by alarm.py only when MOTION_MODE is "detector" or "auto",
+and never together with the motion daemon: both need the camera.
+
+SOURCE (or CAMERA_SOURCE) is "v4l2" for VIDEO_DEVICE, "testsrc" for the
+ffmpeg synthetic pattern, or a file: a .mjpeg file is looped as it is,
+any other video is converted by ffmpeg. apt install ffmpeg
+'''
+
+import sys
+import time
+import struct
+import signal
+import threading
+import traceback
+import subprocess
+from multiprocessing import shared_memory, resource_tracker
+
+from utility import *
+
+CAMERA_SHM = getattr(config, "CAMERA_SHM", "rpi4-alarm-camera")
+CAMERA_SOURCE = getattr(config, "CAMERA_SOURCE", "v4l2")
+CAMERA_SIZE = getattr(config, "CAMERA_SIZE", "1280x720")
+CAMERA_FPS = getattr(config, "CAMERA_FPS", 15)
+# Pixel format asked to the camera, frames not in mjpeg are encoded
+CAMERA_INPUT_FORMAT = getattr(config, "CAMERA_INPUT_FORMAT", "mjpeg")
+CAMERA_BUFFER = getattr(config, "CAMERA_BUFFER", 4)
+CAMERA_PREROLL = getattr(config, "CAMERA_PREROLL", 2)
+CAMERA_FRAME_SIZE = getattr(config, "CAMERA_FRAME_SIZE", 512 * 1024)
+# A buffer without frames newer than this is stale: the daemon is dead
+CAMERA_MAX_AGE = getattr(config, "CAMERA_MAX_AGE", 2)
+
+# Header: magic, slots, slot size, fps, sequence of the last frame
+HEADER = struct.Struct("<4sIIIQ")
+# Slot: sequence, time, length, then the jpeg
+SLOT = struct.Struct("<QdI")
+MAGIC = b"CAM1"
+
+# Errors of grab_photo and record_clip, negative not to be taken for an
+# exit status: the camera must be opened directly instead when the daemon
+# is not running or stale, not when the recording failed
+CAMERA_NOT_RUNNING = -1
+CAMERA_STALE = -2
+CAMERA_RECORD_FAILED = -3
+
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+
+class FrameBuffer:
+    '''
+    Ring buffer of JPEG frames in shared memory, one writer and any number
+    of readers in other processes. A slot is marked invalid while it is
+    written and the readers check its sequence again after the copy.
+    '''
+
+    def __init__(self, shm, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        magic, self.slots, self.slot_size, self.fps, _ = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a frame buffer" % shm.name)
+
+    @classmethod
+    def create(cls, name: str = CAMERA_SHM, slots: int = CAMERA_BUFFER * CAMERA_FPS,
+               slot_size: int = CAMERA_FRAME_SIZE, fps: int = CAMERA_FPS):
+        size = HEADER.size + slots * (SLOT.size + slot_size)
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left by a daemon killed before it could remove it
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, slots, slot_size, fps, 0)
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name: str = CAMERA_SHM):
+        # None if the daemon is not running
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return None
+        # Otherwise the resource tracker removes it when this process exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, False)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def _offset(self, seq: int):
+        return HEADER.size + (seq % self.slots) * (SLOT.size + self.slot_size)
+
+    def last_seq(self):
+        return HEADER.unpack_from(self.shm.buf, 0)[4]
+
+    def write(self, frame: bytes, when: float = None):
+        if len(frame) > self.slot_size:
+            debug("Frame of %d bytes dropped, CAMERA_FRAME_SIZE is %d" % (len(frame), self.slot_size))
+            return False
+        seq = self.last_seq() + 1
+        offset = self._offset(seq)
+        SLOT.pack_into(self.shm.buf, offset, 0, 0, 0)
+        self.shm.buf[offset + SLOT.size:offset + SLOT.size + len(frame)] = frame
+        SLOT.pack_into(self.shm.buf, offset, seq, when or time.time(), len(frame))
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, self.slots, self.slot_size, self.fps, seq)
+        return True
+
+    def read(self, seq: int):
+        # (seq, time, jpeg), or None if the frame was overwritten
+        offset = self._offset(seq)
+        slot_seq, when, length = SLOT.unpack_from(self.shm.buf, offset)
+        if slot_seq != seq:
+            return None
+        frame = bytes(self.shm.buf[offset + SLOT.size:offset + SLOT.size + length])
+        if SLOT.unpack_from(self.shm.buf, offset)[0] != seq:
+            return None
+        return seq, when, frame
+
+    def latest(self, max_age: float = CAMERA_MAX_AGE):
+        seq = self.last_seq()
+        frame = self.read(seq) if seq else None
+        if frame is None or time.time() - frame[1] > max_age:
+            return None
+        return frame
+
+    def frames(self, after: int):
+        # The frames still in the buffer with sequence greater than after
+        last = self.last_seq()
+        frames = []
+        for seq in range(max(after + 1, last - self.slots + 2, 1), last + 1):
+            frame = self.read(seq)
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    def frames_since(self, since: float):
+        return [f for f in self.frames(0) if f[1] >= since]
+
+    def wait(self, after: int, timeout: float):
+        # Poll for a frame newer than after, returns the last sequence
+        deadline = time.time() + timeout
+        while self.last_seq() <= after and time.time() < deadline:
+            time.sleep(0.5 / max(1, self.fps))
+        return self.last_seq()
+
+def split_jpeg(data: bytearray):
+    # Remove the complete frames from data and return them
+    frames = []
+    while True:
+        start = data.find(SOI)
+        if start < 0:
+            del data[:max(0, len(data) - 1)]
+            return frames
+        end = data.find(EOI, start + 2)
+        if end < 0:
+            del data[:start]
+            return frames
+        frames.append(bytes(data[start:end + 2]))
+        del data[:end + 2]
+
+def source_command(source: str):
+    # ffmpeg command writing a mjpeg stream on stdout, None for .mjpeg files
+    args = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+    encode = ["-c:v", "mjpeg", "-q:v", "5"]
+    match source:
+        case "v4l2":
+            args += ["-f", "v4l2", "-input_format", CAMERA_INPUT_FORMAT, "-framerate", str(CAMERA_FPS),
+                     "-video_size", CAMERA_SIZE, "-i", config.VIDEO_DEVICE]
+            if CAMERA_INPUT_FORMAT == "mjpeg":
+                encode = ["-c:v", "copy"]
+        case "testsrc":
+            args += ["-re", "-f", "lavfi", "-i", "testsrc=size=%s:rate=%d" % (CAMERA_SIZE, CAMERA_FPS)]
+        case _ if source.endswith((".mjpeg", ".mjpg")):
+            return None
+        case _:
+            args += ["-re", "-stream_loop", "-1", "-i", source, "-vf", "fps=%d" % CAMERA_FPS]
+    return args + encode + ["-f", "mjpeg", "-"]
+
+class CameraDaemon:
+    def __init__(self, source: str = CAMERA_SOURCE, name: str = CAMERA_SHM):
+        self.source = source
+        self.name = name
+        self.buffer = None
+        self.process = None
+        self.stopping = False
+        self.frames = 0
+
+    def stop(self):
+        self.stopping = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def _capture(self, args: list):
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        data = bytearray()
+        try:
+            while not self.stopping:
+                chunk = self.process.stdout.read1(65536)
+                if not chunk:
+                    break
+                data += chunk
+                for frame in split_jpeg(data):
+                    self.buffer.write(frame)
+                    self.frames += 1
+        finally:
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+        return self.process.returncode
+
+    def _replay(self):
+        # Loop a .mjpeg file at CAMERA_FPS, no ffmpeg needed
+        with open(self.source, "rb") as f:
+            frames = split_jpeg(bytearray(f.read()))
+        if not frames:
+            raise ValueError("No frame in %s" % self.source)
+        next_time = time.time()
+        while not self.stopping:
+            for frame in frames:
+                if self.stopping:
+                    break
+                self.buffer.write(frame)
+                self.frames += 1
+                next_time += 1 / CAMERA_FPS
+                time.sleep(max(0, next_time - time.time()))
+        return 0
+
+    def run(self):
+        self.buffer = FrameBuffer.create(self.name)
+        debug("Camera %s on %s, %d slots" % (self.source, self.name, self.buffer.slots))
+        backoff = 1
+        try:
+            while not self.stopping:
+                start = time.time()
+                try:
+                    args = source_command(self.source)
+                    ret = self._replay() if args is None else self._capture(args)
+                except OSError:
+                    debug(traceback.format_exc())
+                    ret = -1
+                if self.stopping:
+                    break
+                # The camera was unplugged, or ffmpeg died: start it again
+                backoff = 1 if time.time() - start > 60 else min(backoff * 2, 60)
+                debug("Camera capture exited with %s, restarting in %ds" % (ret, backoff))
+                time.sleep(backoff)
+        finally:
+            self.buffer.close()
+
+    def start(self):
+        # Run in a thread of this process, e.g. for tests and benchmarks
+        self.thread = threading.Thread(target=self.run, name="camera", daemon=True)
+        self.thread.start()
+        return self
+
+def grab_photo(path: str, name: str = CAMERA_SHM):
+    # Save the newest frame, returns (path, 0) or (None, error)
+    buffer = FrameBuffer.attach(name)
+    if buffer is None:
+        return None, CAMERA_NOT_RUNNING
+    try:
+        frame = buffer.latest()
+    finally:
+        buffer.close()
+    if frame is None:
+        return None, CAMERA_STALE
+    with open(path, "wb") as f:
+        f.write(frame[2])
+    return path, 0
+
+def record_clip(path: str, seconds: float, preroll: float = CAMERA_PREROLL, name: str = CAMERA_SHM):
+    # Save the frames from preroll seconds ago to seconds from now, as they
+    # are (media.py encodes them), returns (path, 0) or (None, error)
+    buffer = FrameBuffer.attach(name)
+    if buffer is None:
+        return None, CAMERA_NOT_RUNNING
+    try:
+        if buffer.latest() is None:
+            return None, CAMERA_STALE
+        now = time.time()
+        frames = buffer.frames_since(now - preroll)
+        try:
+            process = subprocess.Popen(["ffmpeg", "-y", "-loglevel", "error", "-f", "mjpeg", "-framerate", str(buffer.fps),
+                                        "-i", "-", "-c:v", "copy", path], stdin=subprocess.PIPE)
+        except OSError:
+            debug(traceback.format_exc())
+            return None, CAMERA_RECORD_FAILED
+        last = frames[-1][0] if frames else buffer.last_seq()
+        try:
+            for frame in frames:
+                process.stdin.write(frame[2])
+            while time.time() < now + seconds:
+                buffer.wait(last, CAMERA_MAX_AGE)
+                for frame in buffer.frames(last):
+                    process.stdin.write(frame[2])
+                    last = frame[0]
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        ret = process.wait()
+    finally:
+        buffer.close()
+    if ret != 0:
+        debug("ffmpeg error %d recording %s" % (ret, path))
+        return None, CAMERA_RECORD_FAILED
+    return path, 0
+
+if __name__ == "__main__":
+    daemon = CameraDaemon(sys.argv[1] if len(sys.argv) > 1 else CAMERA_SOURCE)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    daemon.run()
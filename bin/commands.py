@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : commands.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# SMS command handlers.
+#
+# Every handler gets the Command and the Dispatcher: the fast ones reply
+# inline, the slow ones acknowledge right away and hand the real work to a
+# dispatcher group. A handler may return a deferred command line, executed
+# by the main loop only after the SMS has been deleted.
+
+import os
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+from modem import send_sms
+from utility import *
+from upsplus import ups_telemetry
+from battery import battery_monitor
+from mailqueue import queue_mail
+from media import deliver, encode_clip, budget, MEDIA_KEEP
+from storage import media_catalog, IMAGE_KINDS, VIDEO_KINDS
+from metrics import capture_seconds, summary
+
+MOTION_MODE = getattr(config, "MOTION_MODE", "motion")
+
+HELP_MSG="RPI4 Alarm available commands: STOP, RESTART, POWEROFF, REBOOT, MOTION [STOP|START|RESTART], BATTERY, PHOTO, VIDEO [s] [KEEP], LAST [PHOTO|VIDEO|SHEET], SINCE HH:MM, STATS, HELP"
+
+class Command:
+    def __init__(self, modem: str, sender: str, text: str, send = None):
+        # send(text, number) sends the replies, by default on the same modem
+        self.modem = modem
+        self.send = send or (lambda text, number: send_sms(modem, text, number))
+        self.sender = sender
+        self.text = text
+        split = text.split(" ")
+        split.append("")
+        self.name = split[0].upper()
+        self.args = split[1:]
+
+    def reply(self, text: str):
+        sent, ret = self.send(text, config.TRUSTED_PHONE)
+        debug("Reply to %s sent to %s: %s, %s" % (self.name, config.TRUSTED_PHONE, sent, ret))
+        return sent, ret
+
+def motion_active():
+    return subprocess.run(['systemctl', 'status', 'motion']).returncode == 0
+
+def queued(position: int):
+    return (", %d jobs queued before" % position) if position > 0 else ""
+
+# def cmd_stop(command, dispatcher):
+#     command.reply("Shutting down RPI4 Alarm service")
+#     return ['systemctl', 'stop', 'rpi4-alarm']
+
+def cmd_restart(command, dispatcher):
+    command.reply("Restarting RPI4 Alarm service")
+    # Do not wait for the stop: it is this process and the job would hold it
+    return ['systemctl', '--no-block', 'restart', 'rpi4-alarm']
+
+# def cmd_poweroff(command, dispatcher):
+#     command.reply("Shutting down RPI4 Alarm host")
+#     return ['poweroff']
+
+def cmd_reboot(command, dispatcher):
+    command.reply("Restarting RPI4 Alarm host")
+    return ['reboot']
+
+def motion_status(command):
+    result = subprocess.run(['systemctl', 'status', 'motion'])
+    command.reply("Motion detection status %d" % result.returncode)
+
+def detector_motion(command, dispatcher):
+    # MOTION_MODE "detector" or "auto", see detector.py
+    from detector import motion_switch
+    switch = motion_switch()
+    match command.args[0].upper():
+        case "STOP":
+            command.reply("Stopping motion detection")
+            dispatcher.submit("system", switch.arm, False)
+        case "START":
+            command.reply("Starting motion detection")
+            dispatcher.submit("system", switch.arm, True)
+        case "RESTART":
+            command.reply("Restarting motion detection")
+            dispatcher.submit("system", switch.arm, False)
+            dispatcher.submit("system", switch.arm, True)
+        case "STATUS":
+            command.reply(switch.status())
+        case _:
+            command.reply("Invalid command: " + command.text)
+
+def cmd_motion(command, dispatcher):
+    if MOTION_MODE != "motion":
+        return detector_motion(command, dispatcher)
+    match command.args[0].upper():
+        case "STOP":
+            command.reply("Stopping motion detection")
+            return ['systemctl', 'stop', 'motion']
+        case "START":
+            command.reply("Starting motion detection")
+            return ['systemctl', 'start', 'motion']
+        case "RESTART":
+            command.reply("Restarting motion detection")
+            return ['systemctl', 'restart', 'motion']
+        case "STATUS":
+            dispatcher.submit("system", motion_status, command)
+        case _:
+            command.reply("Invalid command: " + command.text)
+
+def cmd_battery(command, dispatcher):
+    telemetry, ret = ups_telemetry()
+    if ret != 0:
+        command.reply("Error %d reading battery status" % ret)
+        return
+    monitor = battery_monitor()
+    monitor.update(telemetry)
+    command.reply(monitor.status())
+
+def take_photo(command):
+    # apt install fswebcam
+    photo_fd, photo_name = tempfile.mkstemp(suffix=".jpg", prefix="photo-", dir=config.LOG_PATH)
+    os.close(photo_fd)
+    os.remove(photo_name)
+    # The newest frame of the capture daemon, fswebcam if it is not running
+    from camera import grab_photo
+    photo, ret = grab_photo(photo_name)
+    if ret == 0:
+        photo_sub = "Photo taken on %s saved in %s" % (datetime.now().strftime("%Y/%m/%d, %H:%M:%S"), photo_name)
+        command.reply(photo_sub)
+        media_catalog().add(photo_name, "photo")
+        return photo_sub, photo_name
+    if motion_active():
+        command.reply("Can't take photo while motion is running")
+        return
+    result = subprocess.run(["fswebcam", "--no-banner", "-d", config.VIDEO_DEVICE, "-r", "1920x1080", photo_name])
+    if result.returncode == 0:
+        photo_sub = "Photo taken on %s saved in %s" % (datetime.now().strftime("%Y/%m/%d, %H:%M:%S"), photo_name)
+        command.reply(photo_sub)
+        media_catalog().add(photo_name, "photo")
+        return photo_sub, photo_name
+    command.reply("Error %d taking photo" % result.returncode)
+
+def cmd_photo(command, dispatcher):
+    # The ack first, a fast job would reply before it
+    command.reply("Taking photo" + queued(dispatcher.position("camera")))
+    dispatcher.submit("camera", photo_job, command, dispatcher)
+
+def photo_job(command, dispatcher):
+    with capture_seconds.time(kind="photo"):
+        photo = take_photo(command)
+    if photo is not None:
+        queue_mail("Alarm photo", *photo)
+
+def record_video(command, video_time: int):
+    video_fd, video_name = tempfile.mkstemp(suffix=".mkv", prefix="video-", dir=config.LOG_PATH)
+    os.close(video_fd)
+    os.remove(video_name)
+    # From the capture daemon with CAMERA_PREROLL seconds before the
+    # command, from the device if it is not running
+    from camera import record_clip, CAMERA_NOT_RUNNING, CAMERA_STALE
+    video, ret = record_clip(video_name, video_time)
+    if ret == 0:
+        video_sub = "Video recorded on %s for %ds in %s" % (datetime.now().strftime("%Y/%m/%d, %H:%M:%S"), video_time, video_name)
+        command.reply(video_sub)
+        media_catalog().add(video_name, "video")
+        return video_sub, video_name
+    if ret not in (CAMERA_NOT_RUNNING, CAMERA_STALE):
+        command.reply("Error recording video from the camera daemon")
+        return
+    if motion_active():
+        command.reply("Can't record a video while motion is running")
+        return
+    result = subprocess.run(["ffmpeg", "-t", "%d" % video_time, "-f", "v4l2", "-framerate", "30", "-video_size", "800x600", "-i", config.VIDEO_DEVICE, "-pix_fmt", "yuv420p", video_name])
+    if result.returncode == 0:
+        video_sub = "Video recorded on %s for %ds in %s" % (datetime.now().strftime("%Y/%m/%d, %H:%M:%S"), video_time, video_name)
+        command.reply(video_sub)
+        media_catalog().add(video_name, "video")
+        return video_sub, video_name
+    command.reply("Error %d recording video" % result.returncode)
+
+def cmd_video(command, dispatcher):
+    video_time = int(command.args[0]) if command.args[0] != "" and command.args[0].isdigit() else 3
+    # VIDEO [s] KEEP mails only the contact sheet
+    keep = "KEEP" in [arg.upper() for arg in command.args]
+    command.reply("Recording video for %ds%s" % (video_time, queued(dispatcher.position("camera"))))
+    dispatcher.submit("camera", video_job, command, dispatcher, video_time, keep)
+
+def video_job(command, dispatcher, video_time: int, keep: bool = False):
+    with capture_seconds.time(kind="video"):
+        video = record_video(command, video_time)
+    if video is not None:
+        deliver("Alarm video", *video, keep or MEDIA_KEEP, dispatcher)
+
+def resend_job(subject: str, rows: list):
+    # Newest first and the small ones before the raw videos, as many as
+    # fit in one mail; a single video too big is encoded
+    if len(rows) == 1 and rows[0][1] in VIDEO_KINDS and rows[0][3] > budget():
+        clip, ret = encode_clip(rows[0][0], os.path.splitext(rows[0][0])[0] + "-mail.mp4")
+        if ret == 0:
+            media_catalog().add(clip, "clip", rows[0][4])
+            rows = [(clip, "clip", rows[0][2], os.path.getsize(clip), rows[0][4])]
+    left = budget()
+    attachments = []
+    for path, kind, when, size, event in sorted(rows, key=lambda r: (r[1] in ("video", "movie"), -r[2])):
+        if size <= left and os.path.exists(path):
+            attachments.append(path)
+            left -= size
+    media_catalog().touch(attachments)
+    body = "\n".join("%s %s %s%s" % (datetime.fromtimestamp(when).strftime("%Y/%m/%d, %H:%M:%S"), kind, path,
+                                      "" if path in attachments else " (not attached)")
+                     for path, kind, when, size, event in rows)
+    queue_mail(subject, body + "\n", attachments)
+
+LAST_KINDS = {"PHOTO": ("photo", "picture"), "VIDEO": VIDEO_KINDS, "SHEET": ("sheet",)}
+
+def cmd_last(command, dispatcher):
+    # LAST [PHOTO|VIDEO|SHEET], a photo by default
+    what = command.args[0].upper() or "PHOTO"
+    if what not in LAST_KINDS:
+        command.reply("Invalid command: " + command.text)
+        return
+    rows = media_catalog().last(LAST_KINDS[what])
+    if not rows:
+        command.reply("No %s found" % what.lower())
+        return
+    position = dispatcher.submit("media", resend_job, "Alarm last %s" % what.lower(), rows)
+    command.reply("Sending %s of %s%s" % (what.lower(), datetime.fromtimestamp(rows[0][2]).strftime("%Y/%m/%d, %H:%M:%S"), queued(position)))
+
+def cmd_since(command, dispatcher):
+    # SINCE HH:MM, today or yesterday if HH:MM is still to come
+    try:
+        clock = datetime.strptime(command.args[0], "%H:%M").time()
+    except ValueError:
+        command.reply("Invalid command: " + command.text)
+        return
+    since = datetime.combine(datetime.now().date(), clock)
+    if since > datetime.now():
+        since -= timedelta(days=1)
+    rows = media_catalog().since(since.timestamp(), IMAGE_KINDS + VIDEO_KINDS)
+    if not rows:
+        command.reply("Nothing since %s" % since.strftime("%Y/%m/%d, %H:%M"))
+        return
+    position = dispatcher.submit("media", resend_job, "Alarm since %s" % since.strftime("%H:%M"), rows)
+    command.reply("Sending %d files since %s%s" % (len(rows), since.strftime("%Y/%m/%d, %H:%M"), queued(position)))
+
+def cmd_stats(command, dispatcher):
+    command.reply(summary())
+
+def cmd_help(command, dispatcher):
+    command.reply(HELP_MSG)
+
+COMMANDS = {
+    # "STOP": cmd_stop,
+    "RESTART": cmd_restart,
+    # "POWEROFF": cmd_poweroff,
+    "REBOOT": cmd_reboot,
+    "MOTION": cmd_motion,
+    "BATTERY": cmd_battery,
+    "PHOTO": cmd_photo,
+    "VIDEO": cmd_video,
+    "LAST": cmd_last,
+    "SINCE": cmd_since,
+    "STATS": cmd_stats,
+    "HELP": cmd_help,
+}
+
+def handle_command(command: Command, dispatcher):
+    debug("Command %s received from %s" % (command.name, command.sender))
+    handler = COMMANDS.get(command.name)
+    if handler is None:
+        sent, ret = command.send("Invalid command: " + command.text, config.TRUSTED_PHONE)
+        debug("Reply to INVALID sent to %s: %s, %s" % (config.TRUSTED_PHONE, sent, ret))
+        return None
+    return handler(command, dispatcher)
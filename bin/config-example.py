@@ -11,11 +11,118 @@ EMAIL_SENDER="motion@paradise.gov"
 EMAIL_ADDRESS="god@paradise.gov"
 EMAIL_PASSWORD="pass123!"
 
+# Outgoing mail server, EMAIL_PASSWORD="" skips the login
+SMTP_HOST="smtp.gmail.com"
+SMTP_PORT=465
+SMTP_SSL=True
+
+# Mail queue, by default in LOG_PATH/spool
+# MAIL_SPOOL="/home/alarm/log/spool"
+MAIL_BATCH_SIZE=20
+MAIL_MAX_ATTEMPTS=20
+
+# Motion events received within MOTION_DIGEST_WINDOW seconds are sent in a
+# single mail, by default the socket is LOG_PATH/motion.sock
+# MOTION_SOCKET="/home/alarm/log/motion.sock"
+MOTION_DIGEST_WINDOW=10
+MOTION_DIGEST_CONCAT=True
+
 TRUSTED_PHONE="+000000000000"
 
 SLEEP_TIME=3
 
+# State restored after a restart, by default LOG_PATH/alarm-state.json;
+# restarts within STARTUP_QUIET_TIME seconds of the last announced one
+# send no mail and no SMS
+# STATE_FILE="/home/alarm/log/alarm-state.json"
+STARTUP_QUIET_TIME=600
+
+# ModemManager access: "mmcli" or "dbus" (needs python3-dbus)
+MODEM_BACKEND="mmcli"
+
+# SMS reception: "poll" every SLEEP_TIME or "event" (needs dbus-monitor)
+RECEIVE_MODE="poll"
+SWEEP_TIME=60
+
+# A modem with MODEM_MAX_ERRORS errors in a row is not used for replies,
+# its polling backs off up to MODEM_MAX_BACKOFF seconds
+MODEM_MAX_ERRORS=3
+MODEM_MAX_BACKOFF=300
+
+# Journal of the SMS handled, by default LOG_PATH/sms-journal.log, and
+# seconds within which the same text from the same phone is a duplicate
+SMS_JOURNAL_DAYS=30
+SMS_DUPLICATE_WINDOW=30
+
+# Outbound SMS: longer texts are cut at SMS_MAX_PARTS concatenated parts,
+# every modem sends at most SMS_RATE parts per minute (SMS_BURST at once),
+# replies sent within SMS_COALESCE_TIME seconds are merged in one SMS
+SMS_MAX_PARTS=4
+SMS_RATE=6
+SMS_BURST=4
+SMS_COALESCE_TIME=1
+SMS_RETRIES=3
+
+# Worker threads for slow commands and per group concurrency limits
+DISPATCH_WORKERS=4
+DISPATCH_LIMITS={"camera": 1, "media": 1, "system": 1}
+
 VIDEO_DEVICE="/dev/video0"
 
+# Capture daemon (camera.py): source ("v4l2", "testsrc" or a video file),
+# size, frame rate, seconds kept in memory and seconds of video before a
+# VIDEO command; PHOTO and VIDEO open the device when it is not running.
+# It runs only with MOTION_MODE "detector" or "auto", never with motion
+CAMERA_SOURCE="v4l2"
+CAMERA_SIZE="1280x720"
+CAMERA_FPS=15
+CAMERA_BUFFER=4
+CAMERA_PREROLL=2
+CAMERA_FRAME_SIZE=512 * 1024
+
+# Motion detection: "motion" daemon, built-in "detector" (needs camera.py,
+# numpy and PIL) or "auto", motion on mains and the detector on battery.
+# The detector analyses DETECTOR_FPS frames per second, DETECTOR_WIDTH
+# pixels wide, and needs DETECTOR_MIN_BLOCKS connected 8x8 changed blocks
+MOTION_MODE="motion"
+DETECTOR_FPS=2
+DETECTOR_WIDTH=160
+DETECTOR_THRESHOLD=25
+DETECTOR_MIN_BLOCKS=4
+
+# Clips are encoded to fit in a MEDIA_MAX_BYTES mail, with the hardware
+# encoder if present ("auto", "h264_v4l2m2m" or "libx264"); a contact sheet
+# is mailed first, then the clip unless MEDIA_KEEP (or VIDEO s KEEP)
+MEDIA_MAX_BYTES=20 * 1024 * 1024
+MEDIA_MAX_BITRATE=2000000
+MEDIA_MAX_WIDTH=1280
+MEDIA_ENCODER="auto"
+MEDIA_SHEET="3x2"
+MEDIA_KEEP=False
+
+# Media catalog (by default LOG_PATH/catalog.db) and, per directory, the
+# maximum bytes and days kept: the least recently used files go first
+STORAGE_QUOTAS={
+    "/home/alarm/log": (2 * 1024 ** 3, 30),
+    "/var/lib/motion": (4 * 1024 ** 3, 14),
+}
+STORAGE_INTERVAL=60
+STORAGE_BATCH=50
+
+# Metrics in the Prometheus text format, written every METRICS_INTERVAL
+# seconds (by default to LOG_PATH/rpi4_alarm.prom) and served on
+# http://127.0.0.1:METRICS_PORT/metrics if METRICS_PORT is not 0
+METRICS_INTERVAL=60
+METRICS_PORT=0
+
+# UPS Plus I2C bus and seconds between reads
+UPS_I2C_BUS="/dev/i2c-1"
+UPS_REFRESH=5
+
+# Battery alerts: thresholds (%), hysteresis (%) and shutdown warning (s)
+BATTERY_THRESHOLDS=[50, 25, 10]
+BATTERY_HYSTERESIS=3
+BATTERY_SHUTDOWN_WARNING=1200
+
 LOG_PATH="/home/alarm/log"
 DEBUG=True
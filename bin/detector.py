@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : detector.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Built-in motion detector, a low power replacement of the motion daemon.
+#
+# It takes DETECTOR_FPS frames per second from the camera.py buffer, lets
+# libjpeg decode them already downscaled (PIL draft mode) to grayscale
+# DETECTOR_WIDTH pixels wide, and compares them with a running average
+# background. The changed pixels are counted in DETECTOR_BLOCK square
+# blocks, and there is motion when DETECTOR_MIN_BLOCKS changed blocks are
+# connected: scattered noise never is.
+#
+# The events are handed to the MotionCollector like the motion hooks do:
+# the best frame as picture and the frames from CAMERA_PREROLL seconds
+# before as movie (mjpeg copied in mkv, nothing is encoded).
+#
+# MOTION_MODE "detector" always uses it, "auto" uses motion on mains and
+# switches to it on battery. apt install python3-numpy python3-pil
+
+import io
+import os
+import time
+import itertools
+import threading
+import traceback
+import subprocess
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from utility import *
+from camera import FrameBuffer, CAMERA_SHM, CAMERA_PREROLL
+from motion_hook import notify
+
+MOTION_MODE = getattr(config, "MOTION_MODE", "motion")
+DETECTOR_FPS = getattr(config, "DETECTOR_FPS", 2)
+DETECTOR_WIDTH = getattr(config, "DETECTOR_WIDTH", 160)
+# Gray levels of difference from the background for a changed pixel
+DETECTOR_THRESHOLD = getattr(config, "DETECTOR_THRESHOLD", 25)
+# Background update rate, lower adapts slower to light changes
+DETECTOR_ALPHA = getattr(config, "DETECTOR_ALPHA", 0.05)
+DETECTOR_BLOCK = getattr(config, "DETECTOR_BLOCK", 8)
+DETECTOR_MIN_BLOCKS = getattr(config, "DETECTOR_MIN_BLOCKS", 4)
+# Over this fraction of changed pixels it is the light, not motion
+DETECTOR_LIGHTSWITCH = getattr(config, "DETECTOR_LIGHTSWITCH", 0.6)
+DETECTOR_EVENT_GAP = getattr(config, "DETECTOR_EVENT_GAP", 2)
+DETECTOR_MOVIE_MAX = getattr(config, "DETECTOR_MOVIE_MAX", 10)
+
+def decode(jpeg: bytes, width: int = DETECTOR_WIDTH):
+    # Grayscale float32 array, width pixels wide
+    image = Image.open(io.BytesIO(jpeg))
+    height = max(1, round(width * image.height / image.width))
+    # Decode at 1/2, 1/4 or 1/8 scale in the DCT, the biggest cost saved
+    image.draft("L", (width, height))
+    image = image.convert("L")
+    if image.size != (width, height):
+        image = image.resize((width, height), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32)
+
+def largest_region(blocks: np.ndarray):
+    # Size of the biggest 4-connected region of True blocks
+    grid = blocks.tolist()
+    rows, cols = len(grid), len(grid[0]) if grid else 0
+    seen = [[False] * cols for _ in range(rows)]
+    largest = 0
+    for y, x in zip(*np.nonzero(blocks)):
+        if seen[y][x]:
+            continue
+        seen[y][x] = True
+        stack = [(y, x)]
+        size = 0
+        while stack:
+            cy, cx = stack.pop()
+            size += 1
+            for ny, nx in ((cy - 1, cx), (cy + 1, cx), (cy, cx - 1), (cy, cx + 1)):
+                if 0 <= ny < rows and 0 <= nx < cols and grid[ny][nx] and not seen[ny][nx]:
+                    seen[ny][nx] = True
+                    stack.append((ny, nx))
+        largest = max(largest, size)
+    return largest
+
+class MotionDetector:
+    def __init__(self, threshold: float = DETECTOR_THRESHOLD, alpha: float = DETECTOR_ALPHA,
+                 block: int = DETECTOR_BLOCK, lightswitch: float = DETECTOR_LIGHTSWITCH):
+        self.threshold = threshold
+        self.alpha = alpha
+        self.block = block
+        self.lightswitch = lightswitch
+        self.background = None
+
+    def feed(self, frame: np.ndarray):
+        # Returns (largest changed region in blocks, fraction of changed pixels)
+        if self.background is None or self.background.shape != frame.shape:
+            self.background = frame.copy()
+            return 0, 0.0
+        delta = frame - self.background
+        changed = np.abs(delta) > self.threshold
+        fraction = float(changed.mean())
+        if fraction > self.lightswitch:
+            # Light turned on or off, or the camera adjusting: start again
+            self.background = frame.copy()
+            return 0, fraction
+        rows, cols = frame.shape[0] // self.block, frame.shape[1] // self.block
+        blocks = changed[:rows * self.block, :cols * self.block].reshape(rows, self.block, cols, self.block).mean(axis=(1, 3)) > 0.25
+        # What moves gets in the background much slower than the rest
+        self.background += np.where(changed, self.alpha / 10, self.alpha) * delta
+        return largest_region(blocks), fraction
+
+class MotionEvent:
+    ids = itertools.count(1)
+
+    def __init__(self, buffer: FrameBuffer, now: float):
+        self.id = "%d" % next(self.ids)
+        self.start = now
+        self.last = now
+        self.score = 0
+        self.best = None
+        name = os.path.join(config.LOG_PATH, "%s-%s" % (datetime.fromtimestamp(now).strftime("%Y%m%d%H%M%S"), self.id))
+        self.picture = name + ".jpg"
+        self.movie = name + ".mkv"
+        self.seq = 0
+        try:
+            self.encoder = subprocess.Popen(["ffmpeg", "-y", "-loglevel", "error", "-f", "mjpeg", "-framerate", str(buffer.fps),
+                                             "-i", "-", "-c:v", "copy", self.movie], stdin=subprocess.PIPE)
+        except OSError:
+            debug(traceback.format_exc())
+            self.encoder = None
+        self.record([f for f in buffer.frames(0) if f[1] >= now - CAMERA_PREROLL])
+
+    def motion(self, now: float, score: int, jpeg: bytes):
+        self.last = now
+        if score > self.score:
+            self.score, self.best = score, jpeg
+
+    def record(self, frames: list):
+        for seq, when, jpeg in frames:
+            if seq <= self.seq:
+                continue
+            self.seq = seq
+            if self.encoder is not None:
+                try:
+                    self.encoder.stdin.write(jpeg)
+                except BrokenPipeError:
+                    self.encoder = None
+
+    def expired(self, now: float):
+        return now - self.last >= DETECTOR_EVENT_GAP or now - self.start >= DETECTOR_MOVIE_MAX
+
+    def finish(self):
+        # Hand picture and movie to the collector, like the motion hooks
+        events = []
+        if self.best is not None:
+            with open(self.picture, "wb") as f:
+                f.write(self.best)
+            events.append(("on_picture_save", self.picture))
+        if self.encoder is not None:
+            try:
+                self.encoder.stdin.close()
+            except BrokenPipeError:
+                pass
+            if self.encoder.wait() == 0:
+                events.append(("on_movie_end", self.movie))
+        events.append(("on_event_end", ""))
+        for event, path in events:
+            try:
+                notify(event, path, self.id)
+            except OSError:
+                debug(traceback.format_exc())
+
+class Detector:
+    def __init__(self, fps: float = DETECTOR_FPS, name: str = CAMERA_SHM):
+        self.fps = fps
+        self.name = name
+        self.detector = MotionDetector()
+        self.event = None
+        self.frames = 0
+        self.events = 0
+        self.stopping = False
+        self.active = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="detector", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.active.set()
+
+    def resume(self):
+        self.active.set()
+
+    def pause(self):
+        self.active.clear()
+
+    def _finish(self):
+        event, self.event = self.event, None
+        debug("Motion event %s: %d blocks, %.1fs" % (event.id, event.score, event.last - event.start))
+        event.finish()
+
+    def _step(self, buffer: FrameBuffer):
+        # False when the buffer is stale and must be attached again
+        frame = buffer.latest()
+        if frame is None:
+            return False
+        seq, when, jpeg = frame
+        score, fraction = self.detector.feed(decode(jpeg))
+        self.frames += 1
+        now = time.time()
+        if score >= DETECTOR_MIN_BLOCKS:
+            if self.event is None:
+                self.event = MotionEvent(buffer, when)
+                self.events += 1
+            self.event.motion(now, score, jpeg)
+        if self.event is not None:
+            self.event.record(buffer.frames(self.event.seq))
+            if self.event.expired(now):
+                self._finish()
+        return True
+
+    def _run(self):
+        buffer = None
+        while not self.stopping:
+            if not self.active.wait(1) or self.stopping:
+                if self.event is not None:
+                    self._finish()
+                continue
+            start = time.time()
+            try:
+                if buffer is None:
+                    buffer = FrameBuffer.attach(self.name)
+                if buffer is None or not self._step(buffer):
+                    # camera.py not running, or restarted with a new buffer
+                    if buffer is not None:
+                        buffer.close()
+                    buffer = None
+                    time.sleep(5)
+            except Exception:
+                debug(traceback.format_exc())
+            time.sleep(max(0, 1 / self.fps - (time.time() - start)))
+        if self.event is not None:
+            self._finish()
+        if buffer is not None:
+            buffer.close()
+
+def systemctl(action: str, unit: str):
+    result = subprocess.run(["systemctl", action, unit])
+    debug("systemctl %s %s: %d" % (action, unit, result.returncode))
+    return result.returncode
+
+class MotionSwitch:
+    '''
+    Runs the motion daemon or the detector. In "auto" mode the motion
+    daemon runs on mains and the detector on battery. camera.py is
+    started here for the detector and stopped while motion runs, as they
+    both need the camera.
+    '''
+
+    def __init__(self, detector: Detector, mode: str = MOTION_MODE):
+        self.detector = detector
+        self.mode = mode
+        self.armed = True
+        self.on_mains = None
+        self.current = None
+        self.lock = threading.Lock()
+
+    def _wanted(self):
+        if not self.armed:
+            return None
+        if self.mode == "auto" and self.on_mains is not False:
+            return "motion"
+        return "detector"
+
+    def update(self, on_mains: bool = None):
+        # Returns a message when the detection changes, otherwise None
+        with self.lock:
+            if on_mains is not None:
+                self.on_mains = on_mains
+            wanted = self._wanted()
+            if wanted == self.current:
+                return None
+            if wanted != "detector":
+                self.detector.pause()
+            if wanted != "motion":
+                systemctl("stop", "motion")
+            if wanted == "detector":
+                systemctl("start", "rpi4-alarm-camera")
+            if wanted == "motion":
+                systemctl("stop", "rpi4-alarm-camera")
+                systemctl("start", "motion")
+            if wanted == "detector":
+                self.detector.resume()
+            previous, self.current = self.current, wanted
+        debug("Motion detection: %s -> %s" % (previous, wanted))
+        match wanted:
+            case "motion":
+                return "Motion detection by the motion daemon"
+            case "detector":
+                return "Motion detection in low power mode"
+        return "Motion detection stopped"
+
+    def arm(self, armed: bool):
+        self.armed = armed
+        return self.update()
+
+    def status(self):
+        return "Motion detection %s (%s mode), %d frames analysed, %d events" % (
+            self.current or "stopped", self.mode, self.detector.frames, self.detector.events)
+
+_switch = None
+_switch_lock = threading.Lock()
+
+def motion_switch():
+    global _switch
+    with _switch_lock:
+        if _switch is None:
+            _switch = MotionSwitch(Detector().start())
+        return _switch
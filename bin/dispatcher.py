@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : dispatcher.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Run the slow jobs (capture, encode, mail, systemctl) out of the main
+# loop on a bounded pool of threads. Every job belongs to a group and each
+# group has its own concurrency limit, e.g. only one camera job at a time:
+# the jobs over the limit wait in the group queue without holding a worker.
+
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utility import *
+
+DISPATCH_WORKERS = getattr(config, "DISPATCH_WORKERS", 4)
+DISPATCH_LIMITS = getattr(config, "DISPATCH_LIMITS", {"camera": 1, "media": 1, "system": 1})
+
+class Dispatcher:
+    def __init__(self, workers: int = DISPATCH_WORKERS, limits: dict = DISPATCH_LIMITS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self.workers = workers
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.running = {}
+        self.pending = {}
+
+    def submit(self, group: str, function, *args):
+        # Returns the number of jobs of the same group waiting before this one
+        with self.lock:
+            running = self.running.get(group, 0)
+            pending = self.pending.setdefault(group, deque())
+            if running < self.limits.get(group, self.workers):
+                self.running[group] = running + 1
+                self.executor.submit(self._run, group, function, args)
+                return 0
+            pending.append((function, args))
+            return len(pending)
+
+    def position(self, group: str):
+        # What submit() would return now, to reply before submitting
+        with self.lock:
+            if self.running.get(group, 0) < self.limits.get(group, self.workers):
+                return 0
+            return len(self.pending.get(group, ())) + 1
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+    def _run(self, group: str, function, args: tuple):
+        try:
+            debug("Job %s %s started" % (group, function.__name__))
+            function(*args)
+            debug("Job %s %s done" % (group, function.__name__))
+        except Exception:
+            debug(traceback.format_exc())
+        finally:
+            with self.lock:
+                pending = self.pending[group]
+                if pending:
+                    function, args = pending.popleft()
+                    self.executor.submit(self._run, group, function, args)
+                else:
+                    self.running[group] -= 1
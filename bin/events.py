@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : events.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Wake up the main loop as soon as ModemManager receives a SMS or a modem
+# is added or removed, instead of polling every SLEEP_TIME seconds.
+#
+# The signals are read from a long-lived dbus-monitor process, so this
+# works with both the mmcli and the dbus backend of modem.py. Any command
+# printing the same output can be used instead (see MODEM_MONITOR_CMD),
+# e.g. a script replaying a recorded dbus-monitor session:
+#
+# signal time=1667898000.0 sender=:1.4 -> destination=(null destination) serial=90 path=/org/freedesktop/ModemManager1/Modem/0; interface=org.freedesktop.ModemManager1.Modem.Messaging; member=Added
+#    object path "/org/freedesktop/ModemManager1/SMS/7"
+#    boolean true
+
+import re
+import time
+import queue
+import threading
+import traceback
+import subprocess
+
+from utility import *
+
+MODEM_MONITOR_CMD = getattr(config, "MODEM_MONITOR_CMD", [
+    "dbus-monitor", "--system",
+    "type='signal',sender='org.freedesktop.ModemManager1',interface='org.freedesktop.ModemManager1.Modem.Messaging',member='Added'",
+    "type='signal',sender='org.freedesktop.ModemManager1',interface='org.freedesktop.DBus.ObjectManager'",
+])
+
+# Signals that wake up the main loop and how many arguments they need
+MODEM_SIGNALS = {"Added": 2, "InterfacesAdded": 1, "InterfacesRemoved": 1}
+
+SIGNAL_RE = re.compile(r"^signal .* path=([^;]*); interface=([^;]*); member=(\w+)")
+ARG_RE = re.compile(r"^\s+(object path|string|boolean) \"?([^\"]*)\"?$")
+
+class ModemWatcher:
+    def __init__(self, command: list = None):
+        self.command = command or MODEM_MONITOR_CMD
+        self.events = queue.Queue()
+        self.alive = False
+        self.process = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="modem-watcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        if self.process is not None:
+            self.process.terminate()
+
+    def wait(self, timeout: float, fallback: float = config.SLEEP_TIME):
+        # Block until at least one event arrives or the timeout expires and
+        # return all the pending events. While the monitor is not running
+        # use the old polling interval.
+        events = []
+        try:
+            events.append(self.events.get(timeout=timeout if self.alive else fallback))
+            while True:
+                events.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+    def _emit(self, member: str, path: str, args: list):
+        # Added is also emitted for the SMS we create to send replies
+        if member == "Added" and args[1:2] != ["true"]:
+            return
+        debug("Modem event %s %s %s" % (member, path, args))
+        self.events.put((member, path, args))
+
+    def _run(self):
+        backoff = 1
+        while not self.stopping:
+            try:
+                self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, text=True)
+                self.alive = True
+                signal = None
+                for line in self.process.stdout:
+                    match = SIGNAL_RE.match(line)
+                    if match:
+                        path, _, member = match.groups()
+                        signal = (member, path, []) if member in MODEM_SIGNALS else None
+                        backoff = 1
+                        continue
+                    match = ARG_RE.match(line.rstrip("\n"))
+                    if match and signal is not None:
+                        member, path, args = signal
+                        args.append(match.group(2))
+                        if len(args) == MODEM_SIGNALS[member]:
+                            self._emit(member, path, args)
+                            signal = None
+                self.process.wait()
+                debug("Modem monitor exited with %d" % self.process.returncode)
+            except Exception:
+                debug(traceback.format_exc())
+            self.alive = False
+            if self.stopping:
+                break
+            # Wake up the main loop, something may have been lost
+            self.events.put(("MonitorLost", "", []))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
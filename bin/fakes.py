@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : fakes.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Stand-ins for the hardware and the services used by the alarm, to run
+# it and benchmark it off-device.
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import threading
+from datetime import datetime
+
+class SMTPSink:
+    '''
+    Minimal SMTP server accepting everything. The messages are discarded
+    while they are received, so its memory does not depend on their size;
+    set keep=True to store them in self.messages.
+    '''
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, keep: bool = False):
+        self.server = socket.create_server((host, port))
+        self.host, self.port = self.server.getsockname()[:2]
+        self.keep = keep
+        self.messages = []
+        self.received = 0
+        self.received_bytes = 0
+        self.sessions = 0
+        self.thread = threading.Thread(target=self._serve, name="smtp-sink", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        self.sessions += 1
+        with conn, conn.makefile("rb") as rfile:
+            conn.sendall(b"220 sink ESMTP\r\n")
+            for line in rfile:
+                command = line[:4].upper()
+                if command in (b"EHLO", b"HELO"):
+                    conn.sendall(b"250-sink\r\n250 AUTH PLAIN LOGIN\r\n")
+                elif command == b"AUTH":
+                    conn.sendall(b"235 2.7.0 Authentication successful\r\n")
+                elif command == b"DATA":
+                    conn.sendall(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    size = 0
+                    data = []
+                    for line in rfile:
+                        if line == b".\r\n":
+                            break
+                        size += len(line)
+                        if self.keep:
+                            data.append(line)
+                    if self.keep:
+                        self.messages.append(b"".join(data))
+                    self.received += 1
+                    self.received_bytes += size
+                    conn.sendall(b"250 2.0.0 Ok: queued\r\n")
+                elif command == b"QUIT":
+                    conn.sendall(b"221 2.0.0 Bye\r\n")
+                    return
+                else:
+                    conn.sendall(b"250 2.0.0 Ok\r\n")
+
+class FakeModem:
+    '''
+    Stand-in for modem.send_sms: takes latency seconds per part, like a
+    modem sending over the air, and records what it sent.
+    '''
+
+    def __init__(self, latency: float = 0.5):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def send_sms(self, modem: str, text: str, number: str):
+        from smstext import sms_parts
+        time.sleep(self.latency * sms_parts(text))
+        with self.lock:
+            self.sent.append((modem, number, text))
+        return True, 0
+
+class FakeI2CBus:
+    '''
+    Stand-in for upsplus.I2CBus, for UPSSampler(bus=...): in memory I2C
+    devices, 256 byte registers for every address. The default values are
+    a UPS on mains power with a full battery; with a curve, a list of
+    (seconds, percentage, on mains) points, the UPS follows it from the
+    creation of the bus, interpolated between points.
+    '''
+
+    def __init__(self, curve: list = None):
+        from upsplus import UPS_ADDRESS, INA219_BATTERY
+        self.ups, self.ina219 = UPS_ADDRESS, INA219_BATTERY
+        self.devices = {}
+        self.reads = 0
+        self.curve = curve
+        self.start = time.monotonic()
+        for register, value in ((0x01, 3300), (0x03, 5100), (0x05, 4150), (0x07, 5200), (0x0B, 30),
+                                (0x0D, 4200), (0x0F, 3200), (0x11, 3000), (0x13, 100), (0x15, 2)):
+            self.set_word(self.ups, register, value)
+        self.set_word(self.ina219, 0x01, 0, big_endian=True)
+
+    def set_word(self, address: int, register: int, value: int, big_endian: bool = False):
+        data = self.devices.setdefault(address, bytearray(256))
+        data[register:register + 2] = struct.pack(">h" if big_endian else "<H", value)
+
+    def _follow_curve(self):
+        elapsed = time.monotonic() - self.start
+        when, percentage, on_mains = self.curve[0]
+        for next_when, next_percentage, next_mains in self.curve[1:]:
+            if elapsed < next_when:
+                percentage += (next_percentage - percentage) * (elapsed - when) / (next_when - when)
+                break
+            when, percentage, on_mains = next_when, next_percentage, next_mains
+        percentage = max(0, min(100, percentage))
+        self.set_word(self.ups, 0x05, int(3200 + 10 * percentage))
+        self.set_word(self.ups, 0x07, 5200 if on_mains else 0)
+        self.set_word(self.ups, 0x13, int(percentage))
+        # About 1A out of the battery, 2.5mV over the shunt
+        self.set_word(self.ina219, 0x01, 0 if on_mains else -250, big_endian=True)
+
+    def read_block(self, address: int, register: int, length: int):
+        if address not in self.devices:
+            raise OSError(121, "Remote I/O error")
+        self.reads += 1
+        if self.curve and address == self.ups:
+            self._follow_curve()
+        return bytes(self.devices[address][register:register + length])
+
+    def close(self):
+        pass
+
+def write_mjpeg(path: str, count: int = 30, size: int = 50000):
+    '''
+    A .mjpeg file for camera.py: count frames of size bytes delimited like
+    JPEG, every one different. Not decodable, use the ffmpeg testsrc for
+    real pictures.
+    '''
+    with open(path, "wb") as f:
+        for i in range(count):
+            payload = bytes((i + j) % 255 for j in range(256)) * (size // 256)
+            f.write(b"\xff\xd8" + payload + b"\xff\xd9")
+    return path
+
+def synthetic_clip(path: str, count: int = 100, size: tuple = (1280, 720), moving: tuple = (40, 80)):
+    '''
+    A decodable .mjpeg file for camera.py and the detector: a noisy static
+    scene, with a box crossing it in the frames from moving[0] to
+    moving[1]. Needs PIL.
+    '''
+    from PIL import Image, ImageDraw, ImageFilter
+    width, height = size
+    scene = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(2)).convert("RGB")
+    with open(path, "wb") as f:
+        for i in range(count):
+            frame = scene.copy()
+            if moving[0] <= i < moving[1]:
+                x = (i - moving[0]) * width // (moving[1] - moving[0])
+                ImageDraw.Draw(frame).rectangle((x, height // 3, x + width // 8, height * 2 // 3), fill=(30, 30, 30))
+            # Sensor noise
+            frame = Image.blend(frame, Image.effect_noise(size, random.randint(5, 15)).convert("RGB"), 0.1)
+            frame.save(f, "JPEG", quality=80)
+    return path
+
+MM_MODEM = "/org/freedesktop/ModemManager1/Modem/%s"
+MM_SMS = "/org/freedesktop/ModemManager1/SMS/%s"
+
+def fake_mmcli(args: list, state: str):
+    '''
+    The mmcli calls of modem.py over a directory: STATE/<n>/ is modem n and
+    STATE/<n>/<id>.json its SMS. Every call is appended to STATE/calls.log.
+    FAKE_MMCLI_LATENCY (seconds) and FAKE_MMCLI_FAILURE (probability) in
+    the environment slow down and fail the calls. Returns (out, returncode).
+    '''
+    time.sleep(float(os.environ.get("FAKE_MMCLI_LATENCY", 0)))
+    failed = random.random() < float(os.environ.get("FAKE_MMCLI_FAILURE", 0))
+    call, modem, sms, out, ret = "unknown", None, None, "", 0
+    if args[:2] == ["-J", "-L"]:
+        call = "list_modem"
+        modems = sorted(d for d in os.listdir(state) if d.isdigit())
+        out = json.dumps({"modem-list": [MM_MODEM % d for d in modems]})
+    elif "-m" in args:
+        modem = args[args.index("-m") + 1].split("/")[-1]
+        directory = os.path.join(state, modem)
+        if not os.path.isdir(directory):
+            call, ret = "no_modem", 1
+        elif "--messaging-list-sms" in args:
+            call = "list_sms"
+            names = sorted((n for n in os.listdir(directory) if n.endswith(".json")), key=lambda n: int(n[:-5]))
+            out = json.dumps({"modem.messaging.sms": [MM_SMS % n[:-5] for n in names]})
+        elif "--sms" in args:
+            call, sms = "read_sms", args[args.index("--sms") + 1].split("/")[-1]
+            try:
+                with open(os.path.join(directory, sms + ".json")) as f:
+                    out = json.dumps({"sms": json.load(f)})
+            except FileNotFoundError:
+                ret = 1
+        elif "--send" in args:
+            call, sms = "send_sms", args[args.index("-s") + 1].split("/")[-1]
+        else:
+            for arg in args:
+                if arg.startswith("--messaging-create-sms="):
+                    # The SMS sent are only logged
+                    call, sms = "create_sms", str(time.time_ns())
+                    out = "Successfully created new SMS: " + MM_SMS % sms
+                elif arg.startswith("--messaging-delete-sms="):
+                    call, sms = "delete_sms", arg.split("=", 1)[1].split("/")[-1]
+                    if not failed:
+                        try:
+                            os.remove(os.path.join(directory, sms + ".json"))
+                        except FileNotFoundError:
+                            pass
+    if failed:
+        out, ret = "", 1
+    record = {"time": time.time(), "call": call, "modem": modem, "sms": sms, "returncode": ret}
+    if call == "create_sms" and not failed:
+        record["text"] = args[-1]
+    with open(os.path.join(state, "calls.log"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+    return out, ret
+
+MM_SIGNAL = ("signal time=%.6f sender=:1.4 -> destination=(null destination) serial=1 path=%s; "
+             "interface=org.freedesktop.ModemManager1.Modem.Messaging; member=Added\n"
+             "   object path \"%s\"\n"
+             "   boolean true\n")
+
+def fake_monitor(state: str):
+    '''
+    Stand-in for dbus-monitor (MODEM_MONITOR_CMD, see events.py): prints
+    the Messaging.Added signals of the SMS received by FakeModemManager,
+    appended to STATE/signals.log, from the time it is started.
+    '''
+    path = os.path.join(state, "signals.log")
+    open(path, "a").close()
+    with open(path) as f:
+        f.seek(0, os.SEEK_END)
+        while True:
+            line = f.readline()
+            if not line:
+                time.sleep(0.05)
+                continue
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+class FakeModemManager:
+    '''
+    A directory of modems with an SMS inbox each and an mmcli executable
+    for it in DIRECTORY/bin: install() puts it first in the PATH of this
+    process and of its children. monitor_command() is a MODEM_MONITOR_CMD
+    signaling the SMS received, for RECEIVE_MODE="event".
+    '''
+
+    def __init__(self, directory: str, modems: int = 1, latency: float = 0, failure: float = 0):
+        self.state = os.path.join(directory, "mm")
+        self.bin = os.path.join(directory, "bin")
+        self.latency = latency
+        self.failure = failure
+        self.lock = threading.Lock()
+        self.next_id = 1
+        for modem in range(modems):
+            os.makedirs(os.path.join(self.state, str(modem)), exist_ok=True)
+        os.makedirs(self.bin, exist_ok=True)
+        mmcli = os.path.join(self.bin, "mmcli")
+        with open(mmcli, "w") as f:
+            f.write("#!/bin/sh\nexec %s %s mmcli \"$@\"\n" % (sys.executable, os.path.abspath(__file__)))
+        os.chmod(mmcli, 0o755)
+
+    def install(self):
+        os.environ["PATH"] = self.bin + os.pathsep + os.environ.get("PATH", "")
+        os.environ["FAKE_MMCLI_STATE"] = self.state
+        os.environ["FAKE_MMCLI_LATENCY"] = str(self.latency)
+        os.environ["FAKE_MMCLI_FAILURE"] = str(self.failure)
+        return self
+
+    def receive(self, text: str, number: str, modem: int = 0):
+        # A new SMS in the inbox of modem, returns its id
+        with self.lock:
+            sms = str(self.next_id)
+            self.next_id += 1
+        body = {
+            "content": {"data": "--", "number": number, "text": text},
+            "dbus-path": MM_SMS % sms,
+            # Microseconds, the journal tells the SMS apart by timestamp
+            "properties": {"state": "received", "storage": "sm", "pdu-type": "deliver",
+                           "timestamp": datetime.now().astimezone().isoformat()},
+        }
+        path = os.path.join(self.state, str(modem), sms + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(body, f)
+        os.replace(path + ".tmp", path)
+        with open(os.path.join(self.state, "signals.log"), "a") as f:
+            f.write(MM_SIGNAL % (time.time(), MM_MODEM % modem, MM_SMS % sms))
+        return sms
+
+    def monitor_command(self):
+        return [sys.executable, os.path.abspath(__file__), "monitor"]
+
+    def calls(self):
+        try:
+            with open(os.path.join(self.state, "calls.log")) as f:
+                return [json.loads(line) for line in f]
+        except FileNotFoundError:
+            return []
+
+if __name__ == "__main__":
+    match sys.argv[1:2]:
+        case ["mmcli"]:
+            out, ret = fake_mmcli(sys.argv[2:], os.environ["FAKE_MMCLI_STATE"])
+            print(out)
+            sys.exit(ret)
+        case ["monitor"]:
+            fake_monitor(os.environ["FAKE_MMCLI_STATE"])
+        case _:
+            sys.exit("usage: fakes.py mmcli ARGS... | fakes.py monitor")
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : mailqueue.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+'''
+Background mail queue.
+
+queue_mail() only writes a small json file in the spool directory, so it
+is cheap enough for the motion hooks and the main loop. A single
+MailSender drains the spool in batches over one authenticated SMTP
+session, kept open while there is work to do. Failed messages stay in
+the spool and are retried with an exponential backoff, also after a
+restart; after MAIL_MAX_ATTEMPTS they are moved to the failed directory.
+
+Run it standalone to deliver the spool without alarm.py:
+
+    mailqueue.py [--once]
+'''
+
+import os
+import sys
+import json
+import time
+import fcntl
+import threading
+import traceback
+
+from utility import *
+from sendmail import mail_log, smtp_connect, send_message
+from metrics import mail_sent, mail_failed
+
+MAIL_SPOOL = getattr(config, "MAIL_SPOOL", os.path.join(config.LOG_PATH, "spool"))
+MAIL_POLL_TIME = getattr(config, "MAIL_POLL_TIME", 5)
+MAIL_IDLE_TIME = getattr(config, "MAIL_IDLE_TIME", 60)
+MAIL_BATCH_SIZE = getattr(config, "MAIL_BATCH_SIZE", 20)
+MAIL_MAX_ATTEMPTS = getattr(config, "MAIL_MAX_ATTEMPTS", 20)
+MAIL_MAX_BACKOFF = getattr(config, "MAIL_MAX_BACKOFF", 3600)
+
+_wakeup = threading.Event()
+
+def spool_dir(name: str):
+    path = os.path.join(MAIL_SPOOL, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _write(path: str, record: dict):
+    # Write and rename, a reader never sees a partial file
+    tmp = os.path.join(spool_dir("tmp"), os.path.basename(path))
+    with open(tmp, "w") as f:
+        json.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def queue_mail(subject: str, body: str, attachment = None):
+    # attachment can be a path or a list of paths
+    name = "%d-%d.json" % (time.time_ns(), os.getpid())
+    path = os.path.join(spool_dir("new"), name)
+    _write(path, {
+        "subject": subject,
+        "body": body,
+        "attachment": attachment,
+        "queued": time.time(),
+        "attempts": 0,
+        "next": 0,
+    })
+    mail_log("* QUEUE %s %s\n" % (subject, attachment))
+    _wakeup.set()
+    return path
+
+def pending_mail():
+    spool = spool_dir("new")
+    return [os.path.join(spool, name) for name in sorted(os.listdir(spool)) if name.endswith(".json")]
+
+class MailSender:
+    def __init__(self):
+        self.server = None
+        self.last_used = 0
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="mail-sender", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        _wakeup.set()
+
+    def _connection(self):
+        import smtplib
+        if self.server is not None and time.time() - self.last_used > MAIL_IDLE_TIME / 2:
+            # The server may have dropped an idle session
+            try:
+                self.server.noop()
+            except smtplib.SMTPException:
+                self._close()
+        if self.server is None:
+            self.server = smtp_connect()
+        self.last_used = time.time()
+        return self.server
+
+    def _close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def _failed(self, path: str, record: dict, permanent: bool):
+        mail_failed.inc(permanent=permanent)
+        record["attempts"] += 1
+        record["error"] = traceback.format_exc(limit=1)
+        if permanent or record["attempts"] >= MAIL_MAX_ATTEMPTS:
+            mail_log("! FAILED %s %s\n" % (record["subject"], record["attachment"]))
+            _write(os.path.join(spool_dir("failed"), os.path.basename(path)), record)
+            os.remove(path)
+        else:
+            record["next"] = time.time() + min(30 * 2 ** (record["attempts"] - 1), MAIL_MAX_BACKOFF)
+            _write(path, record)
+
+    def drain(self):
+        # Returns the number of messages sent; only one process at a time
+        # drains the spool. smtplib is loaded here, in the sender thread
+        import smtplib
+        with open(os.path.join(spool_dir(""), "lock"), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            sent = 0
+            for path in pending_mail():
+                if sent >= MAIL_BATCH_SIZE:
+                    break
+                try:
+                    with open(path) as f:
+                        record = json.load(f)
+                except (OSError, ValueError):
+                    debug(traceback.format_exc())
+                    continue
+                if record["next"] > time.time():
+                    continue
+                try:
+                    send_message(self._connection(), record["subject"], record["body"], record["attachment"])
+                except OSError as e:
+                    # Missing attachment, it will never be sent
+                    if isinstance(e, FileNotFoundError):
+                        self._failed(path, record, True)
+                        continue
+                    # Connection problem: retry later, stop this batch
+                    debug(traceback.format_exc())
+                    self._close()
+                    self._failed(path, record, False)
+                    break
+                except smtplib.SMTPRecipientsRefused:
+                    self._failed(path, record, True)
+                    continue
+                except smtplib.SMTPException:
+                    debug(traceback.format_exc())
+                    self._close()
+                    self._failed(path, record, False)
+                    break
+                os.remove(path)
+                mail_sent.inc()
+                mail_log("# SENT %s %s\n" % (record["subject"], record["attachment"]))
+                sent += 1
+            return sent
+
+    def _run(self):
+        while not self.stopping:
+            _wakeup.clear()
+            try:
+                sent = self.drain()
+            except Exception:
+                debug(traceback.format_exc())
+                sent = 0
+            if sent >= MAIL_BATCH_SIZE:
+                continue
+            if not _wakeup.wait(MAIL_POLL_TIME) and time.time() - self.last_used > MAIL_IDLE_TIME:
+                self._close()
+        self._close()
+
+if __name__ == "__main__":
+    sender = MailSender()
+    if "--once" in sys.argv:
+        while sender.drain() >= MAIL_BATCH_SIZE:
+            pass
+        sender._close()
+    else:
+        sender._run()
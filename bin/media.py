@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : media.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Media processing between capture and mail.
+#
+# The clips are recorded as they come from the camera and encoded here in
+# h264, with the bitrate that makes them fit in MEDIA_MAX_BYTES once
+# base64 encoded: on the Pi hardware encoder (h264_v4l2m2m) when present,
+# with libx264 otherwise. A contact sheet of the clip is mailed first,
+# small enough to arrive quickly over the cellular uplink, then the clip,
+# unless it is kept locally. apt install ffmpeg
+
+import os
+import subprocess
+import traceback
+
+from utility import *
+from mailqueue import queue_mail
+from storage import media_catalog
+
+# Size of a mail the provider accepts
+MEDIA_MAX_BYTES = getattr(config, "MEDIA_MAX_BYTES", 20 * 1024 * 1024)
+MEDIA_MIN_BITRATE = getattr(config, "MEDIA_MIN_BITRATE", 150000)
+MEDIA_MAX_BITRATE = getattr(config, "MEDIA_MAX_BITRATE", 2000000)
+MEDIA_MAX_WIDTH = getattr(config, "MEDIA_MAX_WIDTH", 1280)
+# "auto", "h264_v4l2m2m" or "libx264"
+MEDIA_ENCODER = getattr(config, "MEDIA_ENCODER", "auto")
+MEDIA_THUMB_WIDTH = getattr(config, "MEDIA_THUMB_WIDTH", 320)
+MEDIA_SHEET = getattr(config, "MEDIA_SHEET", "3x2")
+# Do not mail the clips, only their contact sheet
+MEDIA_KEEP = getattr(config, "MEDIA_KEEP", False)
+
+# Pi 4 stateful encoder
+HARDWARE_ENCODER = "h264_v4l2m2m"
+HARDWARE_DEVICE = "/dev/video11"
+
+def ffmpeg(args: list):
+    try:
+        return subprocess.run(["ffmpeg", "-y", "-loglevel", "error"] + args).returncode == 0
+    except OSError:
+        debug(traceback.format_exc())
+        return False
+
+def duration(path: str):
+    # Seconds, None if unknown
+    try:
+        result = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                                stdout=subprocess.PIPE, text=True)
+        return float(result.stdout.strip())
+    except (OSError, ValueError):
+        return None
+
+_encoders = None
+
+def encoders():
+    # The encoders to try, the hardware one first
+    global _encoders
+    if _encoders is None:
+        _encoders = ["libx264"]
+        if MEDIA_ENCODER == HARDWARE_ENCODER or (MEDIA_ENCODER == "auto" and os.path.exists(HARDWARE_DEVICE)):
+            try:
+                result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], stdout=subprocess.PIPE, text=True)
+                if HARDWARE_ENCODER in result.stdout:
+                    _encoders.insert(0, HARDWARE_ENCODER)
+            except OSError:
+                pass
+        debug("Media encoders: %s" % ", ".join(_encoders))
+    return _encoders
+
+def budget(share: float = 1):
+    # Bytes of media in a mail: base64 takes 4/3, leave room for the rest
+    return int(MEDIA_MAX_BYTES * share * 3 / 4) - 64 * 1024
+
+def bitrate(seconds: float, size: int):
+    # Bits per second for size bytes in seconds, 5% for the container
+    return max(MEDIA_MIN_BITRATE, min(MEDIA_MAX_BITRATE, int(size * 8 * 0.95 / max(seconds, 1))))
+
+def encoder_args(encoder: str, rate: int):
+    scale = ["-vf", "scale='min(%d,iw)':-2" % MEDIA_MAX_WIDTH, "-pix_fmt", "yuv420p"]
+    if encoder == HARDWARE_ENCODER:
+        return scale + ["-c:v", encoder, "-b:v", str(rate)]
+    return scale + ["-c:v", encoder, "-preset", "veryfast", "-b:v", str(rate),
+                    "-maxrate", str(rate), "-bufsize", str(2 * rate)]
+
+def encode_clip(source: str, output: str, size: int = None):
+    # Encode source in at most size bytes, returns (output, 0) or (None, error)
+    size = size or budget()
+    seconds = duration(source) or 10
+    rate = bitrate(seconds, size)
+    for encoder in encoders():
+        for attempt in range(2):
+            if not ffmpeg(["-i", source, "-an"] + encoder_args(encoder, rate) + ["-movflags", "+faststart", output]):
+                break
+            encoded = os.path.getsize(output)
+            debug("Encoded %s with %s at %d bps: %d bytes" % (source, encoder, rate, encoded))
+            if encoded <= size:
+                return output, 0
+            # The encoder overshoot, try again a bit lower
+            rate = max(MEDIA_MIN_BITRATE, int(rate * size / encoded * 0.9))
+        else:
+            # Over budget even the second time, send it anyway
+            return output, 0
+    if os.path.exists(output):
+        os.remove(output)
+    return None, 1
+
+def thumbnail(source: str, output: str, at: float = 0):
+    return ffmpeg(["-ss", "%.2f" % at, "-i", source, "-frames:v", "1", "-vf", "scale=%d:-2" % MEDIA_THUMB_WIDTH,
+                   "-q:v", "5", output])
+
+def contact_sheet(source: str, output: str):
+    # MEDIA_SHEET tiles evenly taken from the clip, or a single thumbnail
+    columns, rows = (int(n) for n in MEDIA_SHEET.split("x"))
+    seconds = duration(source)
+    if seconds and ffmpeg(["-i", source, "-vf", "fps=%f,scale=%d:-2,tile=%s" % (columns * rows / seconds, MEDIA_THUMB_WIDTH, MEDIA_SHEET),
+                           "-frames:v", "1", "-q:v", "5", output]):
+        return True
+    return thumbnail(source, output, (seconds or 0) / 3)
+
+def send_clip(subject: str, body: str, clip: str):
+    # Encode and mail the clip, the recording is removed
+    encoded, ret = encode_clip(clip, os.path.splitext(clip)[0] + "-mail.mp4")
+    if ret != 0:
+        queue_mail(subject + " (clip)", body + "\n\nError encoding the clip, mailed as it is\n", clip)
+        return
+    os.remove(clip)
+    media_catalog().remove(clip)
+    media_catalog().add(encoded, "clip")
+    queue_mail(subject + " (clip)", body, encoded)
+
+def deliver(subject: str, body: str, clip: str, keep: bool = MEDIA_KEEP, dispatcher = None):
+    # Contact sheet first, then the clip: encoded in the dispatcher "media"
+    # group if there is one, or kept locally
+    sheet = os.path.splitext(clip)[0] + "-sheet.jpg"
+    if contact_sheet(clip, sheet):
+        media_catalog().add(sheet, "sheet")
+    else:
+        sheet = None
+    if keep:
+        queue_mail(subject, body + "\n\nThe clip is kept in %s\n" % clip, sheet)
+        return
+    queue_mail(subject, body + "\n\nThe clip follows in another mail\n", sheet)
+    if dispatcher is not None:
+        dispatcher.submit("media", send_clip, subject, body, clip)
+    else:
+        send_clip(subject, body, clip)
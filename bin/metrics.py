@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : metrics.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Counters and histograms for the hot paths (modem, UPS, mail, capture,
+# commands), in the Prometheus text format: written to METRICS_FILE every
+# METRICS_INTERVAL seconds (for the node_exporter textfile collector) and,
+# if METRICS_PORT is set, served on http://127.0.0.1:METRICS_PORT/metrics.
+#
+# An observation is a dict lookup and an addition under a lock, cheap
+# enough for every modem call.
+
+import os
+import time
+import bisect
+import threading
+import traceback
+from contextlib import contextmanager
+
+from utility import *
+
+METRICS_FILE = getattr(config, "METRICS_FILE", os.path.join(config.LOG_PATH, "rpi4_alarm.prom"))
+METRICS_INTERVAL = getattr(config, "METRICS_INTERVAL", 60)
+METRICS_PORT = getattr(config, "METRICS_PORT", 0)
+
+# Seconds, from a fast I2C read to a slow mail upload
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _labels(labels: dict):
+    return tuple(sorted(labels.items()))
+
+def _format(name: str, labels: tuple, extra: tuple = ()):
+    pairs = labels + extra
+    if not pairs:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs))
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            if labels:
+                return self.values.get(_labels(labels), 0)
+            return sum(self.values.values())
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append("%s %g" % (_format(self.name, key), value))
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels: [bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _merged(self, labels: dict):
+        # Counts of the matching series summed, labels can be partial
+        wanted = set(labels.items())
+        merged = [0] * (len(self.buckets) + 2)
+        with self.lock:
+            for key, counts in self.values.items():
+                if wanted <= set(key):
+                    merged = [a + b for a, b in zip(merged, counts)]
+        return merged
+
+    def count(self, **labels):
+        return sum(self._merged(labels)[:-1])
+
+    def percentile(self, p: float, **labels):
+        # Upper bound of the bucket with the p-th percentile, None if empty
+        counts = self._merged(labels)[:-1]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = total * p / 100
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append("%s %d" % (_format(self.name + "_bucket", key, (("le", "+Inf" if bound == float("inf") else "%g" % bound),)), cumulative))
+                lines.append("%s %g" % (_format(self.name + "_sum", key), counts[-1]))
+                lines.append("%s %d" % (_format(self.name + "_count", key), cumulative))
+        return lines
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def _metric(cls, name: str, help: str):
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, help)
+        return _metrics[name]
+
+def counter(name: str, help: str = ""):
+    return _metric(Counter, name, help)
+
+def histogram(name: str, help: str = ""):
+    return _metric(Histogram, name, help)
+
+def render():
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+# The metrics of the hot paths
+modem_seconds = histogram("rpi4_alarm_modem_call_seconds", "ModemManager calls by function")
+modem_errors = counter("rpi4_alarm_modem_call_errors_total", "ModemManager calls failed by function")
+ups_seconds = histogram("rpi4_alarm_ups_read_seconds", "UPS Plus I2C reads")
+ups_errors = counter("rpi4_alarm_ups_read_errors_total", "UPS Plus I2C reads failed")
+mail_connect_seconds = histogram("rpi4_alarm_mail_connect_seconds", "SMTP connection and login")
+mail_upload_seconds = histogram("rpi4_alarm_mail_upload_seconds", "SMTP message upload")
+mail_sent = counter("rpi4_alarm_mail_sent_total", "Mail sent")
+mail_failed = counter("rpi4_alarm_mail_failed_total", "Mail delivery attempts failed")
+mail_bytes = counter("rpi4_alarm_mail_attachment_bytes_total", "Attachment bytes sent")
+capture_seconds = histogram("rpi4_alarm_capture_seconds", "Photo and video capture by kind")
+command_seconds = histogram("rpi4_alarm_command_seconds", "From SMS read to the end of its handler, by command")
+sms_delay_seconds = histogram("rpi4_alarm_sms_delay_seconds", "From the SMS timestamp to its read")
+sms_queue_seconds = histogram("rpi4_alarm_sms_queue_seconds", "From reply queued to sent")
+loop_seconds = histogram("rpi4_alarm_loop_seconds", "Main loop pass, without the sleep")
+modem_pass_seconds = histogram("rpi4_alarm_modem_pass_seconds", "Modem worker pass over the SMS")
+ready_seconds = histogram("rpi4_alarm_ready_seconds", "From the start of alarm.py to ready to handle commands")
+first_command_seconds = histogram("rpi4_alarm_first_command_seconds", "From the start of alarm.py to the first command handled")
+
+def _ms(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return ">%gs" % BUCKETS[-1]
+    return "%gs" % seconds if seconds >= 1 else "%dms" % (seconds * 1000)
+
+def summary():
+    # Compact enough for a SMS
+    return "\n".join([
+        "Cmd %d p50 %s p95 %s" % (command_seconds.count(), _ms(command_seconds.percentile(50)), _ms(command_seconds.percentile(95))),
+        "SMS out p95 %s, in delay p95 %s" % (_ms(sms_queue_seconds.percentile(95)), _ms(sms_delay_seconds.percentile(95))),
+        "Modem %d calls %d err p95 %s" % (modem_seconds.count(), modem_errors.value(), _ms(modem_seconds.percentile(95))),
+        "UPS %d reads %d err p95 %s" % (ups_seconds.count(), ups_errors.value(), _ms(ups_seconds.percentile(95))),
+        "Mail %d sent %d fail, connect p95 %s upload p95 %s" % (mail_sent.value(), mail_failed.value(),
+                                                              _ms(mail_connect_seconds.percentile(95)), _ms(mail_upload_seconds.percentile(95))),
+        "Capture %d photo %d video" % (capture_seconds.count(kind="photo"), capture_seconds.count(kind="video")),
+        "Loop p95 %s" % _ms(loop_seconds.percentile(95)),
+        "Start ready %s first cmd %s" % (_ms(ready_seconds.percentile(50)), _ms(first_command_seconds.percentile(50))),
+    ])
+
+def write_file(path: str = METRICS_FILE):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+def _http_server(port: int):
+    # http.server is slow to import, only when METRICS_PORT is set
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    # Only on localhost, there is no authentication
+    return ThreadingHTTPServer(("127.0.0.1", port), Handler)
+
+class MetricsExporter:
+    def __init__(self, path: str = METRICS_FILE, port: int = METRICS_PORT):
+        self.path = path
+        self.port = port
+        self.server = None
+        self.stopping = False
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+
+    def start(self):
+        if self.port:
+            self.server = _http_server(self.port)
+            threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.server is not None:
+            self.server.shutdown()
+
+    def _run(self):
+        while not self.stopping:
+            if self.path:
+                try:
+                    write_file(self.path)
+                except OSError:
+                    debug(traceback.format_exc())
+            self.wakeup.wait(METRICS_INTERVAL)
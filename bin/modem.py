@@ -11,14 +11,15 @@
 # https://gitlab.freedesktop.org/mobile-broadband/ModemManager/
 
 import subprocess
+import traceback
 import json
 
 from utility import *
+from smstext import fit_text, quote_text
 
-def fix_text(string: str):
-    if len(string) > 160:
-        return (string[:157]+"...").replace("'", " ")
-    return string.replace("'", " ")
+# "mmcli" forks mmcli for every call, "dbus" keeps a connection to the
+# system bus (see modem_dbus.py) and falls back to mmcli if not available
+MODEM_BACKEND = getattr(config, "MODEM_BACKEND", "mmcli")
 
 def list_modem():
     # mmcli -J -L
@@ -75,9 +76,9 @@ def send_sms(modem: str, text: str, number: str):
     # Successfully created new SMS: /org/freedesktop/ModemManager1/SMS/9
     # mmcli -m /org/freedesktop/ModemManager1/Modem/0 -s /org/freedesktop/ModemManager1/SMS/9 --send
     # successfully sent the SMS
-    # FIXME:
+    # Long texts are sent as concatenated SMS, quotes are handled by quote_text:
     # https://gitlab.freedesktop.org/mobile-broadband/ModemManager/-/issues/657
-    result = subprocess.run(['mmcli', '-m', modem, '''--messaging-create-sms=text="%s",number="%s"''' % (fix_text(text), number)], stdout=subprocess.PIPE)
+    result = subprocess.run(['mmcli', '-m', modem, '''--messaging-create-sms=text=%s,number="%s"''' % (quote_text(fit_text(text)), number)], stdout=subprocess.PIPE)
     debug("arg:\n", result.args, "out:\n", result.stdout, "err:\n", result.stderr)
     if result.returncode == 0:
         sms = result.stdout.decode("utf-8").split("\n")[0].split(" ")[4]
@@ -92,3 +93,11 @@ def delete_sms(modem: str, sms: str):
     result = subprocess.run(['mmcli', '-m', modem, '--messaging-delete-sms=%s' % sms], stdout=subprocess.PIPE)
     debug("arg:\n", result.args, "out:\n", result.stdout, "err:\n", result.stderr)
     return result.returncode==0, result.returncode
+
+if MODEM_BACKEND == "dbus":
+    try:
+        import modem_dbus
+        modem_dbus.system_bus()
+        from modem_dbus import list_modem, list_sms, read_sms, send_sms, delete_sms
+    except Exception:
+        debug("D-Bus backend not available, falling back to mmcli:\n%s" % traceback.format_exc())
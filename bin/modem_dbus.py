@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : modem_dbus.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# ModemManager D-Bus API:
+# https://www.freedesktop.org/software/ModemManager/api/latest/ref-dbus.html
+#
+# Same functions as modem.py, but instead of forking mmcli for every call
+# they use a single long-lived connection to the system bus.
+# apt install python3-dbus
+
+import threading
+import traceback
+
+import dbus
+
+from utility import *
+from smstext import fit_text
+
+MM_NAME = "org.freedesktop.ModemManager1"
+MM_PATH = "/org/freedesktop/ModemManager1"
+MM_MODEM = MM_NAME + ".Modem"
+MM_MESSAGING = MM_NAME + ".Modem.Messaging"
+MM_SMS = MM_NAME + ".Sms"
+DBUS_PROPERTIES = "org.freedesktop.DBus.Properties"
+DBUS_OBJECT_MANAGER = "org.freedesktop.DBus.ObjectManager"
+
+# Return code used when a D-Bus call fails, mmcli exits with 1 too
+DBUS_ERROR = 1
+
+# MMSmsState, MMSmsPduType and MMSmsStorage as printed by mmcli
+SMS_STATE = ["unknown", "stored", "receiving", "received", "sending", "sent"]
+SMS_PDU_TYPE = ["unknown", "deliver", "submit", "status-report"]
+SMS_STORAGE = ["unknown", "sm", "me", "mt", "sr", "bm", "ta"]
+
+_bus = None
+_lock = threading.Lock()
+
+def system_bus():
+    global _bus
+    with _lock:
+        if _bus is None:
+            _bus = dbus.SystemBus()
+        return _bus
+
+def _reset():
+    # Drop the connection, the next call will open a new one
+    global _bus
+    with _lock:
+        _bus = None
+
+def _interface(path: str, interface: str):
+    return dbus.Interface(system_bus().get_object(MM_NAME, path), interface)
+
+def _enum(names: list, value):
+    return names[int(value)] if 0 <= int(value) < len(names) else "--"
+
+def _text(value):
+    return str(value) if value else "--"
+
+def _call(default, function, *args):
+    # libdbus connections are thread safe, the modem workers can call
+    # concurrently
+    try:
+        return function(*args), 0
+    except dbus.exceptions.DBusException:
+        debug(traceback.format_exc())
+        _reset()
+        return default, DBUS_ERROR
+
+def _list_modem():
+    objects = _interface(MM_PATH, DBUS_OBJECT_MANAGER).GetManagedObjects()
+    return sorted(str(path) for path, interfaces in objects.items() if MM_MODEM in interfaces)
+
+def _list_sms(modem: str):
+    return [str(sms) for sms in _interface(modem, MM_MESSAGING).List()]
+
+def _read_sms(modem: str, sms: str):
+    # Same layout of "mmcli -J -m MODEM --sms SMS"
+    props = _interface(sms, DBUS_PROPERTIES).GetAll(MM_SMS)
+    return {
+        "content": {
+            "data": "--",
+            "number": str(props.get("Number", "")),
+            "text": str(props.get("Text", "")),
+        },
+        "dbus-path": sms,
+        "properties": {
+            "class": _text(props.get("Class", 0)),
+            "delivery-report": "--",
+            "delivery-state": _text(props.get("DeliveryState", 0)),
+            "discharge-timestamp": _text(props.get("DischargeTimestamp", "")),
+            "message-reference": _text(props.get("MessageReference", 0)),
+            "pdu-type": _enum(SMS_PDU_TYPE, props.get("PduType", 0)),
+            "service-category": _text(props.get("ServiceCategory", 0)),
+            "smsc": _text(props.get("SMSC", "")),
+            "state": _enum(SMS_STATE, props.get("State", 0)),
+            "storage": _enum(SMS_STORAGE, props.get("Storage", 0)),
+            "teleservice-id": _text(props.get("TeleserviceId", 0)),
+            "timestamp": _text(props.get("Timestamp", "")),
+            "validity": "--",
+        },
+    }
+
+def _send_sms(modem: str, text: str, number: str):
+    messaging = _interface(modem, MM_MESSAGING)
+    sms = messaging.Create(dbus.Dictionary({"text": text, "number": number}, signature="sv"))
+    try:
+        _interface(sms, MM_SMS).Send()
+    finally:
+        messaging.Delete(sms)
+    return True
+
+def _delete_sms(modem: str, sms: str):
+    _interface(modem, MM_MESSAGING).Delete(dbus.ObjectPath(sms))
+    return True
+
+def list_modem():
+    return _call([], _list_modem)
+
+def list_sms(modem: str):
+    return _call([], _list_sms, modem)
+
+def read_sms(modem: str, sms: str):
+    return _call({}, _read_sms, modem, sms)
+
+def send_sms(modem: str, text: str, number: str):
+    # No quoting here, ModemManager splits long texts in concatenated SMS
+    return _call(False, _send_sms, modem, fit_text(text), number)
+
+def delete_sms(modem: str, sms: str):
+    return _call(False, _delete_sms, modem, sms)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : modems.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# One worker thread per modem, so a slow or wedged modem does not hold up
+# the others. Every worker keeps its own state (SMS being handled, last
+# error, health, backoff); the pool starts and stops the workers when the
+# modems come and go, and sends the replies through the healthiest one.
+
+import time
+import threading
+import traceback
+
+from utility import *
+from metrics import modem_seconds, modem_errors, modem_pass_seconds
+
+MODEM_MAX_BACKOFF = getattr(config, "MODEM_MAX_BACKOFF", 300)
+# Consecutive errors after which a modem is not used for the replies
+MODEM_MAX_ERRORS = getattr(config, "MODEM_MAX_ERRORS", 3)
+
+class ModemWorker:
+    def __init__(self, modem: str, handler, interval: float):
+        self.modem = modem
+        self.handler = handler
+        self.interval = interval
+        self.pending = set()
+        self.errors = 0
+        self.latency = 0.0
+        self.backoff = 0
+        self.last_ok = 0
+        self.retry_in = None
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="modem-%s" % modem.split("/")[-1], daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def retry(self, seconds: float):
+        # Next pass within seconds, called by the handler, e.g. for a
+        # message still being received
+        self.retry_in = seconds if self.retry_in is None else min(self.retry_in, seconds)
+
+    def healthy(self):
+        return self.errors < MODEM_MAX_ERRORS
+
+    def health(self):
+        # Sort key, lower is better
+        return (not self.healthy(), self.errors, self.latency)
+
+    def call(self, function, *args):
+        # Call a modem.py function on this modem and keep track of how it
+        # went: function(modem, *args) returns (result, error)
+        start = time.time()
+        result, error = function(self.modem, *args)
+        elapsed = time.time() - start
+        modem_seconds.observe(elapsed, call=function.__name__)
+        if error != 0:
+            modem_errors.inc(call=function.__name__)
+        with self.lock:
+            self._account(error, elapsed)
+        return result, error
+
+    def _account(self, error: int, elapsed: float):
+        self.latency = 0.8 * self.latency + 0.2 * elapsed if self.latency else elapsed
+        if error == 0:
+            self.errors = 0
+            self.backoff = 0
+            self.last_ok = time.time()
+        else:
+            self.errors += 1
+            self.backoff = min(max(1, self.backoff * 2), MODEM_MAX_BACKOFF)
+            debug("Modem %s error %d (%d in a row)" % (self.modem, error, self.errors))
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.clear()
+            self.retry_in = None
+            try:
+                with modem_pass_seconds.time():
+                    self.handler(self)
+            except Exception:
+                debug(traceback.format_exc())
+            wait = self.interval + self.backoff
+            if self.retry_in is not None:
+                wait = min(wait, self.retry_in)
+            self.wakeup.wait(wait)
+        debug("Modem %s worker stopped" % self.modem)
+
+class ModemPool:
+    def __init__(self, handler, interval: float):
+        self.handler = handler
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.workers = {}
+
+    def update(self, modem_list: list):
+        # Start and stop the workers, returns the modems added and removed
+        with self.lock:
+            added = [m for m in modem_list if m not in self.workers]
+            removed = [m for m in self.workers if m not in modem_list]
+            for modem in removed:
+                debug("Modem %s removed" % modem)
+                self.workers.pop(modem).stop()
+            for modem in added:
+                debug("Modem %s added" % modem)
+                self.workers[modem] = ModemWorker(modem, self.handler, self.interval)
+                self.workers[modem].start()
+        return added, removed
+
+    def modems(self):
+        with self.lock:
+            return list(self.workers)
+
+    def wake(self, modem: str = None):
+        with self.lock:
+            for worker in self.workers.values():
+                if modem is None or worker.modem == modem:
+                    worker.wake()
+
+    def ranked(self):
+        with self.lock:
+            return sorted(self.workers.values(), key=ModemWorker.health)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : motion_hook.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+'''
+Hook for the motion on_picture_save, on_movie_end and on_event_end
+events (see etc/motion/motion.conf):
+
+    motion_hook.py EVENT FILE [EVENT_ID]
+
+The event is handed to the collector running in alarm.py, which sends
+one digest mail for a whole burst of events. If the collector is not
+running the mail is queued directly, like sendmail.py does.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+
+import config
+
+# Keep this script light: it runs for every picture and movie
+MOTION_SOCKET = getattr(config, "MOTION_SOCKET", os.path.join(config.LOG_PATH, "motion.sock"))
+
+def notify(event: str, path: str, event_id: str):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.sendto(json.dumps({"event": event, "file": path, "id": event_id, "time": time.time()}).encode(), MOTION_SOCKET)
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        raise Exception("Invalid parameter in motion_hook")
+    event, path = sys.argv[1], sys.argv[2]
+    event_id = sys.argv[3] if len(sys.argv) == 4 else ""
+    try:
+        notify(event, path, event_id)
+    except OSError:
+        if event != "on_event_end":
+            from datetime import datetime
+            from mailqueue import queue_mail
+            queue_mail("Motion Alert (%s)" % event, "Motion Alert on %s" % str(datetime.now()), path)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : motionevents.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Collect the motion events sent by motion_hook.py and coalesce them in a
+# single digest mail.
+#
+# A digest is opened by the first event and closed when no event arrives
+# for MOTION_DIGEST_WINDOW seconds (or after MOTION_DIGEST_MAX seconds of
+# continuous motion). It contains a strip of thumbnails of all the
+# pictures, the best picture and the movies, concatenated in a single clip
+# if MOTION_DIGEST_CONCAT is set. The movies are encoded by media.py, in
+# the dispatcher "media" group so the events keep being read meanwhile,
+# and follow in a second mail. apt install ffmpeg
+
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+import traceback
+from datetime import datetime
+
+from utility import *
+from mailqueue import queue_mail
+from media import ffmpeg, encode_clip, budget, MEDIA_KEEP
+from storage import media_catalog
+from motion_hook import MOTION_SOCKET
+
+MOTION_DIGEST_WINDOW = getattr(config, "MOTION_DIGEST_WINDOW", 10)
+MOTION_DIGEST_MAX = getattr(config, "MOTION_DIGEST_MAX", 120)
+MOTION_DIGEST_CONCAT = getattr(config, "MOTION_DIGEST_CONCAT", True)
+MOTION_DIGEST_THUMBS = getattr(config, "MOTION_DIGEST_THUMBS", 6)
+MOTION_DIGEST_MOVIES = getattr(config, "MOTION_DIGEST_MOVIES", 4)
+
+class Digest:
+    def __init__(self, now: float):
+        self.start = now
+        self.last = now
+        self.events = set()
+        self.pictures = []
+        self.movies = []
+
+    def add(self, event: dict):
+        self.last = time.time()
+        self.events.add(event.get("id", ""))
+        match event.get("event"):
+            case "on_picture_save":
+                self.pictures.append(event["file"])
+                media_catalog().add(event["file"], "picture", event.get("id"))
+            case "on_movie_end":
+                self.movies.append(event["file"])
+                media_catalog().add(event["file"], "movie", event.get("id"))
+
+    def expired(self, now: float):
+        return now - self.last >= MOTION_DIGEST_WINDOW or now - self.start >= MOTION_DIGEST_MAX
+
+def best_picture(pictures: list):
+    # motion already saves the best picture of every event (picture_output
+    # best), among them keep the biggest jpeg, i.e. the most detailed one
+    existing = [p for p in pictures if os.path.exists(p)]
+    return max(existing, key=os.path.getsize) if existing else None
+
+def thumbnail_strip(pictures: list, output: str, height: int = 120):
+    # Side by side thumbnails of up to MOTION_DIGEST_THUMBS pictures (at
+    # least two) evenly taken from the digest
+    step = max(1, len(pictures) / MOTION_DIGEST_THUMBS)
+    selected = [pictures[int(i * step)] for i in range(min(len(pictures), MOTION_DIGEST_THUMBS))]
+    args = []
+    for picture in selected:
+        args += ["-i", picture]
+    scale = "".join("[%d]scale=-2:%d[t%d];" % (i, height, i) for i in range(len(selected)))
+    stack = "".join("[t%d]" % i for i in range(len(selected)))
+    args += ["-filter_complex", "%s%shstack=inputs=%d" % (scale, stack, len(selected)), "-frames:v", "1", output]
+    return ffmpeg(args)
+
+def concat_movies(movies: list, output: str):
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as playlist:
+        for movie in movies:
+            playlist.write("file '%s'\n" % movie.replace("'", "'\\''"))
+        playlist.flush()
+        return ffmpeg(["-f", "concat", "-safe", "0", "-i", playlist.name, "-c", "copy", output])
+
+def send_movies(subject: str, body: str, name: str, movies: list):
+    # Concatenated and encoded to share one mail, minutes on a Pi
+    if len(movies) > 1 and MOTION_DIGEST_CONCAT:
+        clip = os.path.join(config.LOG_PATH, name + os.path.splitext(movies[0])[1])
+        if concat_movies(movies, clip):
+            media_catalog().add(clip, "movie")
+            movies = [clip]
+    movies = movies[:MOTION_DIGEST_MOVIES]
+    encoded = []
+    for movie in movies:
+        clip, ret = encode_clip(movie, os.path.splitext(movie)[0] + "-mail.mp4", budget(1 / len(movies)))
+        if ret == 0:
+            media_catalog().add(clip, "clip")
+        encoded.append(clip if ret == 0 else movie)
+    queue_mail(subject + " (movies)", body, encoded)
+
+def send_digest(digest: Digest, dispatcher = None):
+    pictures = [p for p in digest.pictures if os.path.exists(p)]
+    movies = [m for m in digest.movies if os.path.exists(m)]
+    attachments = []
+    name = datetime.fromtimestamp(digest.start).strftime("digest-%Y%m%d%H%M%S")
+
+    if len(pictures) > 1:
+        strip = os.path.join(config.LOG_PATH, name + "-strip.jpg")
+        if thumbnail_strip(pictures, strip):
+            media_catalog().add(strip, "sheet")
+            attachments.append(strip)
+    best = best_picture(pictures)
+    if best is not None:
+        attachments.append(best)
+
+    body = "Motion detected from %s to %s\n\n%d events, %d pictures, %d movies\n\n%s\n" % (
+        datetime.fromtimestamp(digest.start).strftime("%Y/%m/%d, %H:%M:%S"),
+        datetime.fromtimestamp(digest.last).strftime("%H:%M:%S"),
+        len(digest.events), len(digest.pictures), len(digest.movies),
+        "\n".join(digest.pictures + digest.movies))
+    subject = "Motion Alert (%d events)" % len(digest.events)
+    # The pictures first, then the movies encoded to share one mail
+    if MEDIA_KEEP or not movies:
+        queue_mail(subject, body, attachments)
+        return
+    queue_mail(subject, body + "\nThe movies follow in another mail\n", attachments)
+    if dispatcher is not None:
+        dispatcher.submit("media", send_movies, subject, body, name, movies)
+    else:
+        send_movies(subject, body, name, movies)
+
+class MotionCollector:
+    def __init__(self, path: str = MOTION_SOCKET, dispatcher = None):
+        # dispatcher: where the movies are encoded, in this thread if None
+        self.path = path
+        self.dispatcher = dispatcher
+        self.digest = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="motion-collector", daemon=True)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1)
+        # motion runs as its own user
+        os.chmod(self.path, 0o666)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+
+    def _flush(self):
+        digest, self.digest = self.digest, None
+        debug("Motion digest: %d events, %d pictures, %d movies" % (len(digest.events), len(digest.pictures), len(digest.movies)))
+        try:
+            send_digest(digest, self.dispatcher)
+        except Exception:
+            debug(traceback.format_exc())
+
+    def _run(self):
+        while not self.stopping:
+            try:
+                event = json.loads(self.sock.recv(65536))
+                if self.digest is None:
+                    self.digest = Digest(time.time())
+                self.digest.add(event)
+            except socket.timeout:
+                pass
+            except Exception:
+                debug(traceback.format_exc())
+            if self.digest is not None and self.digest.expired(time.time()):
+                self._flush()
+        self.sock.close()
+        os.remove(self.path)
+        if self.digest is not None:
+            self._flush()
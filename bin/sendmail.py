@@ -14,67 +14,158 @@ This is sendmail
 
 import os
 import sys
-import email, smtplib, ssl
+import uuid
+import base64
+import mimetypes
+import contextlib
 import traceback
 
-from email import encoders
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
 from datetime import datetime
 
 import config
 
-def send_mail_with_auth(subject: str, body: str, attachment: str = None):
-    try:
-        with open(os.path.join(config.LOG_PATH, "sendmail.log"), "a") as log:
-            log.write("* SEND %s %s\n" % (subject, attachment))
-
-        message = MIMEMultipart()
-        message["From"] = config.EMAIL_SENDER
-        message["To"] = config.EMAIL_ADDRESS
-        message["Subject"] = subject
-
-        message.attach(MIMEText(body, "plain"))
-
-        if attachment is not None:
-            with open(attachment, "rb") as af:
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(af.read())
-
-            encoders.encode_base64(part)
-
-            part.add_header(
-                "Content-Disposition",
-                f"attachment; filename= {os.path.basename(attachment)}",
-            )
-            message.attach(part)
-
-        text = message.as_string()
-
+from metrics import mail_connect_seconds, mail_upload_seconds, mail_bytes
+
+SMTP_HOST = getattr(config, "SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = getattr(config, "SMTP_PORT", 465)
+SMTP_SSL = getattr(config, "SMTP_SSL", True)
+SMTP_TIMEOUT = getattr(config, "SMTP_TIMEOUT", 60)
+
+def mail_log(line: str):
+    with open(os.path.join(config.LOG_PATH, "sendmail.log"), "a") as log:
+        log.write(line)
+
+# Read the attachments 57 * 1152 bytes at a time: every chunk becomes
+# exactly 1152 base64 lines of 76 characters
+CHUNK_SIZE = 57 * 1152
+
+def iter_attachment(af):
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    while True:
+        size = af.readinto(buffer)
+        if not size:
+            break
+        yield base64.encodebytes(view[:size]).replace(b"\n", b"\r\n")
+
+def attachment_list(attachment):
+    # A single path, a list of paths or None
+    if attachment is None:
+        return []
+    return [attachment] if isinstance(attachment, str) else list(attachment)
+
+def iter_message(subject: str, body: str, attachments: list = ()):
+    # Generate the message as CRLF terminated bytes, a chunk at a time, so
+    # the attachments are never fully in memory. No line starts with a dot:
+    # everything except the headers is base64.
+    # email and smtplib are imported only to send, they are slow to load
+    import email.policy
+    from email.message import EmailMessage
+    from email.mime.base import MIMEBase
+    from email.mime.text import MIMEText
+    boundary = "===============%s==" % uuid.uuid4().hex
+
+    headers = EmailMessage(policy=email.policy.SMTP)
+    headers["From"] = config.EMAIL_SENDER
+    headers["To"] = config.EMAIL_ADDRESS
+    headers["Subject"] = subject
+    headers["MIME-Version"] = "1.0"
+    headers["Content-Type"] = 'multipart/mixed; boundary="%s"' % boundary
+    yield b"".join(headers.policy.fold_binary(name, value) for name, value in headers.items()) + b"\r\n"
+
+    delimiter = b"--%s\r\n" % boundary.encode()
+    yield delimiter
+    yield MIMEText(body, "plain", "utf-8").as_bytes(policy=email.policy.SMTP)
+
+    for attachment, af in attachments:
+        mime_type = mimetypes.guess_type(attachment)[0] or "application/octet-stream"
+        part = MIMEBase(*mime_type.split("/"))
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header(
+            "Content-Disposition",
+            f"attachment; filename= {os.path.basename(attachment)}",
+        )
+        yield b"\r\n" + delimiter
+        yield part.as_bytes(policy=email.policy.SMTP)
+        yield from iter_attachment(af)
+
+    yield b"\r\n--%s--\r\n" % boundary.encode()
+
+def smtp_connect():
+    with mail_connect_seconds.time():
+        return _smtp_connect()
+
+def _smtp_connect():
+    import smtplib
+    if SMTP_SSL:
+        import ssl
         context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=SMTP_TIMEOUT)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    try:
+        if config.EMAIL_PASSWORD:
             server.login(config.EMAIL_ADDRESS, config.EMAIL_PASSWORD)
-            server.sendmail(config.EMAIL_SENDER, config.EMAIL_ADDRESS, text)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def send_message(server, subject: str, body: str, attachment = None):
+    # Like server.sendmail(), but the DATA is streamed from iter_message().
+    # Open the attachments first: if one is missing nothing is sent.
+    import smtplib
+    with contextlib.ExitStack() as stack:
+        attachments = [(path, stack.enter_context(open(path, "rb"))) for path in attachment_list(attachment)]
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(config.EMAIL_SENDER)
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, config.EMAIL_SENDER)
+        code, resp = server.rcpt(config.EMAIL_ADDRESS)
+        if code not in (250, 251):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused({config.EMAIL_ADDRESS: (code, resp)})
+        code, resp = server.docmd("data")
+        if code != 354:
+            server.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        with mail_upload_seconds.time():
+            for chunk in iter_message(subject, body, attachments):
+                server.send(chunk)
+            server.send(b".\r\n")
+            code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        mail_bytes.inc(sum(os.fstat(af.fileno()).st_size for path, af in attachments))
+
+def send_mail_with_auth(subject: str, body: str, attachment = None):
+    # Synchronous delivery on a new connection, see mailqueue.py to send
+    # in the background
+    try:
+        mail_log("* SEND %s %s\n" % (subject, attachment))
+
+        with smtp_connect() as server:
+            send_message(server, subject, body, attachment)
 
-        with open(os.path.join(config.LOG_PATH, "sendmail.log"), "a") as log:
-            log.write("# SENT %s %s\n" % (subject, attachment))
+        mail_log("# SENT %s %s\n" % (subject, attachment))
 
     except Exception:
-        with open(os.path.join(config.LOG_PATH, "sendmail.log"), "a") as log:
-            log.write("Error while %s %s:\n\n%s\n\n" % (subject, attachment, traceback.format_exc()))
+        mail_log("Error while %s %s:\n\n%s\n\n" % (subject, attachment, traceback.format_exc()))
 
 if __name__ == "__main__":
+    # Called by motion: just drop the message in the spool, the sender
+    # running in alarm.py (or mailqueue.py) will deliver it
+    from mailqueue import queue_mail
     match len(sys.argv):
         case 3:
-            send_mail_with_auth(
+            queue_mail(
                 "Motion Alert (%s)" % sys.argv[1],
                 "Motion Alert on %s" % str(datetime.now()),
                 sys.argv[2]
             )
         case 2:
-            send_mail_with_auth(
+            queue_mail(
                 "Motion Alert (%s)" % sys.argv[1],
                 "Motion Alert on %s" % str(datetime.now())
             )
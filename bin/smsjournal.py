@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : smsjournal.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Journal of the SMS already handled.
+#
+# Every SMS is identified by a hash of (sender, timestamp, text) and
+# recorded in an append only file, fsynced, before its command runs: if
+# the service restarts before the SMS is deleted from the modem, the
+# command is not executed again. The same text resent by the same phone
+# within SMS_DUPLICATE_WINDOW seconds is a duplicate too: the SMS
+# timestamps are compared, not the time they are read, as a batch read
+# after a restart or a modem outage can span hours.
+#
+# The journal is compacted, keeping the last SMS_JOURNAL_DAYS days, when
+# it grows over SMS_JOURNAL_SIZE lines.
+#
+# Line format: key content-key time ("-" when a key is not kept), the
+# time is the SMS timestamp
+
+import os
+import time
+import hashlib
+import threading
+
+from utility import *
+
+SMS_JOURNAL = getattr(config, "SMS_JOURNAL", os.path.join(config.LOG_PATH, "sms-journal.log"))
+SMS_JOURNAL_SIZE = getattr(config, "SMS_JOURNAL_SIZE", 1000)
+SMS_JOURNAL_DAYS = getattr(config, "SMS_JOURNAL_DAYS", 30)
+SMS_DUPLICATE_WINDOW = getattr(config, "SMS_DUPLICATE_WINDOW", 30)
+
+def _hash(*fields):
+    return hashlib.sha1("\0".join(fields).encode("utf-8")).hexdigest()[:20]
+
+def sms_keys(sms_body: dict):
+    content = sms_body.get("content", {})
+    sender = content.get("number", "")
+    text = content.get("text", "")
+    timestamp = sms_body.get("properties", {}).get("timestamp", "")
+    return _hash(sender, timestamp, text), _hash(sender, text)
+
+class SmsJournal:
+    def __init__(self, path: str = SMS_JOURNAL):
+        self.path = path
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.contents = {}
+        self.lines = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    # Skip a line truncated by a crash
+                    if len(fields) == 3:
+                        self._index(fields[0], fields[1], float(fields[2]))
+        self.file = open(path, "a")
+
+    def _index(self, key: str, content: str, when: float):
+        if key != "-":
+            self.keys[key] = when
+        if content != "-":
+            self.contents[content] = max(when, self.contents.get(content, 0))
+        self.lines += 1
+
+    def claim(self, key: str, content: str, sent: float = None, now: float = None):
+        # Record a new SMS sent at time sent (its timestamp, now if
+        # unknown) and return None, or return why it must be skipped
+        now = now or time.time()
+        sent = sent or now
+        with self.lock:
+            if key in self.keys:
+                return "already handled"
+            if content in self.contents and abs(sent - self.contents[content]) < SMS_DUPLICATE_WINDOW:
+                return "duplicate"
+            self.file.write("%s %s %.3f\n" % (key, content, sent))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._index(key, content, sent)
+            if self.lines > SMS_JOURNAL_SIZE:
+                self._compact(now)
+        return None
+
+    def _compact(self, now: float):
+        limit = now - SMS_JOURNAL_DAYS * 86400
+        keys = sorted((when, key) for key, when in self.keys.items() if when >= limit)[-SMS_JOURNAL_SIZE // 2:]
+        contents = {content: when for content, when in self.contents.items() if when >= now - SMS_DUPLICATE_WINDOW}
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for when, key in keys:
+                f.write("%s %s %.3f\n" % (key, "-", when))
+            for content, when in contents.items():
+                f.write("%s %s %.3f\n" % ("-", content, when))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.file.close()
+        self.file = open(self.path, "a")
+        self.keys = {key: when for when, key in keys}
+        self.contents = contents
+        self.lines = len(keys) + len(contents)
+        debug("SMS journal compacted to %d lines" % self.lines)
+
+_journal = None
+_journal_lock = threading.Lock()
+
+def sms_journal():
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = SmsJournal()
+        return _journal
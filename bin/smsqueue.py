@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : smsqueue.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Outbound SMS queue.
+#
+# send() only queues the message and returns. One sender thread takes the
+# messages by priority, merges the ones waiting for the same number in a
+# single (concatenated) SMS up to SMS_MAX_PARTS parts, and sends them
+# through the healthiest modem that is within its rate limit: every modem
+# has a token bucket of SMS_RATE parts per minute, SMS_BURST at most.
+#
+# A message with a key replaces the one with the same key still waiting,
+# e.g. only the last battery alert is sent.
+
+import time
+import heapq
+import itertools
+import threading
+import traceback
+
+from modem import send_sms
+from smstext import sms_parts, SMS_MAX_PARTS
+from utility import *
+from metrics import sms_queue_seconds
+
+SMS_RATE = getattr(config, "SMS_RATE", 6)
+SMS_BURST = getattr(config, "SMS_BURST", 4)
+SMS_COALESCE_TIME = getattr(config, "SMS_COALESCE_TIME", 1)
+SMS_RETRIES = getattr(config, "SMS_RETRIES", 3)
+
+# Priorities, lower first
+URGENT = 0
+REPLY = 1
+STATUS = 2
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        # rate in tokens per second
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def wait_time(self, tokens: int):
+        # Seconds before tokens are available, 0 if they are now
+        self._refill()
+        return max(0, (min(tokens, self.burst) - self.tokens) / self.rate)
+
+    def take(self, tokens: int):
+        self._refill()
+        self.tokens -= tokens
+
+class Message:
+    def __init__(self, priority: int, text: str, number: str, key: str = None):
+        self.priority = priority
+        self.text = text
+        self.number = number
+        self.key = key
+        self.queued = time.time()
+        self.attempts = 0
+        self.cancelled = False
+
+class SmsQueue:
+    def __init__(self, pool, send = send_sms):
+        # pool: the ModemPool, send(modem, text, number): modem.send_sms
+        self.pool = pool
+        self.send_function = send
+        self.heap = []
+        self.keys = {}
+        self.counter = itertools.count()
+        self.buckets = {}
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.sending = False
+        self.sent = 0
+        self.parts = 0
+        self.merged = 0
+        self.latency = []
+        self.thread = threading.Thread(target=self._run, name="sms-sender", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def send(self, text: str, number: str, priority: int = REPLY, key: str = None):
+        # Same signature as send_sms without the modem, but only queues
+        message = Message(priority, text, number, key)
+        with self.condition:
+            if key is not None and key in self.keys:
+                self.keys[key].cancelled = True
+            if key is not None:
+                self.keys[key] = message
+            heapq.heappush(self.heap, (priority, next(self.counter), message))
+            self.condition.notify_all()
+        return True, 0
+
+    def snapshot(self):
+        # The messages not sent yet, to be restored after a restart
+        with self.condition:
+            return [(m.priority, m.text, m.number, m.key) for _, _, m in sorted(self.heap, key=lambda e: e[:2]) if not m.cancelled]
+
+    def restore(self, messages: list):
+        for priority, text, number, key in messages:
+            self.send(text, number, priority, key)
+
+    def pending(self):
+        with self.condition:
+            return sum(1 for _, _, m in self.heap if not m.cancelled)
+
+    def flush(self, timeout: float):
+        # Wait for the queue to be empty, e.g. before a restart
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.sending or any(not m.cancelled for _, _, m in self.heap):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.condition.wait(left)
+        return True
+
+    def _pop(self):
+        # The first message and the others for the same number that fit in
+        # SMS_MAX_PARTS, called with the condition held
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None, []
+        _, _, first = heapq.heappop(self.heap)
+        batch = [first]
+        text = first.text
+        rest = []
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            message = entry[2]
+            if message.cancelled:
+                continue
+            merged = text + "\n" + message.text
+            if message.number == first.number and sms_parts(merged) <= SMS_MAX_PARTS:
+                batch.append(message)
+                text = merged
+            else:
+                rest.append(entry)
+        for entry in rest:
+            heapq.heappush(self.heap, entry)
+        for message in batch:
+            if message.key is not None and self.keys.get(message.key) is message:
+                del self.keys[message.key]
+        return text, batch
+
+    def _bucket(self, modem: str):
+        if modem not in self.buckets:
+            self.buckets[modem] = TokenBucket(SMS_RATE / 60, SMS_BURST)
+        return self.buckets[modem]
+
+    def _deliver(self, text: str, number: str):
+        # Returns (sent, seconds to wait before trying again)
+        parts = sms_parts(text)
+        workers = self.pool.ranked()
+        if not workers:
+            return False, 5
+        wait = min(self._bucket(w.modem).wait_time(parts) for w in workers)
+        if wait > 0:
+            return False, wait
+        for worker in workers:
+            bucket = self._bucket(worker.modem)
+            if bucket.wait_time(parts) > 0:
+                continue
+            bucket.take(parts)
+            sent, ret = worker.call(self.send_function, text, number)
+            debug("SMS sent on %s to %s: %s, %s" % (worker.modem, number, sent, ret))
+            if sent:
+                self.parts += parts
+                return True, 0
+        return False, 0
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not self.heap:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                urgent = self.heap[0][0] == URGENT
+            if not urgent:
+                # Let a burst of replies and status messages pile up
+                time.sleep(SMS_COALESCE_TIME)
+            with self.condition:
+                text, batch = self._pop()
+                self.sending = bool(batch)
+            if not batch:
+                continue
+            try:
+                sent, wait = self._deliver(text, batch[0].number)
+            except Exception:
+                debug(traceback.format_exc())
+                sent, wait = False, 5
+            if sent:
+                self.sent += 1
+                self.merged += len(batch) - 1
+                now = time.time()
+                self.latency += [now - m.queued for m in batch]
+                for message in batch:
+                    sms_queue_seconds.observe(now - message.queued)
+                del self.latency[:-1000]
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+                continue
+            # Back in the queue: rate limited, or failed on every modem
+            with self.condition:
+                for message in batch:
+                    if wait == 0:
+                        message.attempts += 1
+                    if message.attempts >= SMS_RETRIES:
+                        debug("SMS to %s dropped: %s" % (message.number, message.text))
+                        continue
+                    heapq.heappush(self.heap, (message.priority, next(self.counter), message))
+                    if message.key is not None and message.key not in self.keys:
+                        self.keys[message.key] = message
+                self.sending = False
+                self.condition.notify_all()
+                self.condition.wait(wait or 5)
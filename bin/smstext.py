@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : smstext.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# SMS text helpers.
+#
+# ModemManager splits a long text in a concatenated SMS by itself, here we
+# only count the parts (GSM 7 bit when possible, UCS-2 otherwise), to cut
+# the text at SMS_MAX_PARTS, and quote it for mmcli.
+
+from utility import *
+
+SMS_MAX_PARTS = getattr(config, "SMS_MAX_PARTS", 4)
+
+# 3GPP TS 23.038 default alphabet and extension table
+GSM_BASIC = set("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+                "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM_EXTENSION = set("^{}\\[~]|€\f")
+
+def is_gsm(text: str):
+    return all(c in GSM_BASIC or c in GSM_EXTENSION for c in text)
+
+def sms_length(text: str):
+    # Septets for GSM 7 bit, UTF-16 code units for UCS-2
+    if is_gsm(text):
+        return sum(2 if c in GSM_EXTENSION else 1 for c in text), True
+    return len(text.encode("utf-16-le")) // 2, False
+
+def sms_parts(text: str):
+    length, gsm = sms_length(text)
+    single, multi = (160, 153) if gsm else (70, 67)
+    return 1 if length <= single else -(-length // multi)
+
+def fit_text(text: str, max_parts: int = SMS_MAX_PARTS):
+    # Cut the text, only if needed, to fit in max_parts SMS
+    if sms_parts(text) <= max_parts:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if sms_parts(text[:middle] + "...") <= max_parts:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + "..."
+
+def quote_text(text: str):
+    # mmcli has no escape in key=value strings, a value ends at the first
+    # matching quote: use the quote not in the text, or turn the double
+    # quotes into single ones (see ModemManager issue 657)
+    if '"' not in text:
+        return '"%s"' % text
+    if "'" not in text:
+        return "'%s'" % text
+    return '"%s"' % text.replace('"', "'")
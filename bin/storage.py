@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------
+# Project: RPI4 Alarm
+# Source : storage.py
+# Date   : Tue Nov  8 09:59:30 AM CET 2022
+# Author : Andrea Bravetti
+# ---------------------------------------------------------------
+
+# Catalog of the media files and their retention.
+#
+# Every photo, video, clip, motion picture and movie (and the invalid SMS
+# logs) is recorded in a SQLite catalog with its kind, time, size and
+# event, when it is written or, for the files written by others, when its
+# directory is scanned. The catalog answers LAST and SINCE without reading
+# the directories.
+#
+# Every root in STORAGE_QUOTAS has a size and an age limit: a background
+# thread removes the files over them, least recently used first, at most
+# STORAGE_BATCH files at a time. The files still waiting to be mailed are
+# never removed.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import traceback
+
+from utility import *
+from mailqueue import pending_mail
+from sendmail import attachment_list
+
+STORAGE_DB = getattr(config, "STORAGE_DB", os.path.join(config.LOG_PATH, "catalog.db"))
+# Directory: (max bytes, max days)
+STORAGE_QUOTAS = getattr(config, "STORAGE_QUOTAS", {
+    config.LOG_PATH: (2 * 1024 ** 3, 30),
+    "/var/lib/motion": (4 * 1024 ** 3, 14),
+})
+STORAGE_INTERVAL = getattr(config, "STORAGE_INTERVAL", 60)
+STORAGE_SCAN_TIME = getattr(config, "STORAGE_SCAN_TIME", 3600)
+STORAGE_BATCH = getattr(config, "STORAGE_BATCH", 50)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    time REAL NOT NULL,
+    size INTEGER NOT NULL,
+    event TEXT,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_kind_time ON media (kind, time);
+CREATE INDEX IF NOT EXISTS media_time ON media (time);
+CREATE INDEX IF NOT EXISTS media_root_used ON media (root, used);
+"""
+
+# Kinds answered by LAST and SINCE
+IMAGE_KINDS = ("photo", "picture", "sheet")
+VIDEO_KINDS = ("clip", "video", "movie")
+
+def media_kind(name: str):
+    # Kind of a file from its name, None for the files not in the catalog
+    base, ext = os.path.splitext(os.path.basename(name))
+    match ext.lower():
+        case ".jpg" | ".jpeg":
+            if base.startswith("photo-"):
+                return "photo"
+            if base.endswith(("-sheet", "-strip")):
+                return "sheet"
+            return "picture"
+        case ".mkv" | ".mp4" | ".avi":
+            if base.startswith("video-"):
+                return "video"
+            if base.endswith("-mail"):
+                return "clip"
+            return "movie"
+        case ".json" if base.startswith("invalid-sms-"):
+            return "invalid-sms"
+    return None
+
+def media_root(path: str):
+    # The quota directory of path, its own directory if none
+    directory = os.path.dirname(os.path.abspath(path))
+    for root in STORAGE_QUOTAS:
+        if directory == os.path.abspath(root):
+            return root
+    return directory
+
+def pending_attachments():
+    # Files referenced by the mails not sent yet
+    paths = set()
+    for name in pending_mail():
+        try:
+            with open(name) as f:
+                paths.update(os.path.abspath(a) for a in attachment_list(json.load(f).get("attachment")))
+        except (OSError, ValueError):
+            pass
+    return paths
+
+class MediaCatalog:
+    def __init__(self, path: str = STORAGE_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def _query(self, sql: str, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def add(self, path: str, kind: str = None, event: str = None):
+        # Returns False if the file does not exist
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        kind = kind or media_kind(path) or "other"
+        # Not used since written
+        self._query("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    path, media_root(path), kind, stat.st_mtime, stat.st_size, event, stat.st_mtime)
+        return True
+
+    def remove(self, path: str):
+        self._query("DELETE FROM media WHERE path = ?", os.path.abspath(path))
+
+    def touch(self, paths: list):
+        # Used now, the last to be evicted
+        with self.lock:
+            self.db.executemany("UPDATE media SET used = ? WHERE path = ?", [(time.time(), p) for p in paths])
+
+    def last(self, kinds: tuple, count: int = 1):
+        # (path, kind, time, size, event) of the newest files, newest first
+        return self._query("SELECT path, kind, time, size, event FROM media WHERE kind IN (%s) ORDER BY time DESC LIMIT ?"
+                           % ",".join("?" * len(kinds)), *kinds, count)
+
+    def since(self, when: float, kinds: tuple):
+        return self._query("SELECT path, kind, time, size, event FROM media WHERE time >= ? AND kind IN (%s) ORDER BY time"
+                           % ",".join("?" * len(kinds)), when, *kinds)
+
+    def usage(self, root: str):
+        # (files, bytes)
+        count, size = self._query("SELECT COUNT(*), SUM(size) FROM media WHERE root = ?", root)[0]
+        return count, size or 0
+
+    def expired(self, root: str, before: float, limit: int, exclude: set = ()):
+        # Not the excluded paths, or they would fill the LIMIT on every pass
+        return [row[0] for row in self._query("SELECT path FROM media WHERE root = ? AND time < ? AND path NOT IN (%s) ORDER BY time LIMIT ?"
+                                              % ",".join("?" * len(exclude)), root, before, *exclude, limit)]
+
+    def least_used(self, root: str, limit: int, exclude: set = ()):
+        return self._query("SELECT path, size FROM media WHERE root = ? AND path NOT IN (%s) ORDER BY used LIMIT ?"
+                           % ",".join("?" * len(exclude)), root, *exclude, limit)
+
+    def sync(self, root: str):
+        # Add the files written by others, drop the ones removed by others
+        known = {row[0] for row in self._query("SELECT path FROM media WHERE root = ?", root)}
+        found = set()
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_file() and media_kind(entry.name) is not None:
+                    found.add(os.path.abspath(entry.path))
+        for path in found - known:
+            self.add(path)
+        for path in known - found:
+            self.remove(path)
+        return len(found - known), len(known - found)
+
+class StorageManager:
+    def __init__(self, catalog: MediaCatalog, quotas: dict = STORAGE_QUOTAS):
+        self.catalog = catalog
+        self.quotas = quotas
+        self.scanned = {}
+        self.removed = 0
+        self.stopping = False
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="storage", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    def _delete(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            debug(traceback.format_exc())
+            return False
+        self.catalog.remove(path)
+        self.removed += 1
+        return True
+
+    def step(self):
+        # One pass over the roots, returns True if more is left to remove
+        now = time.time()
+        protected = pending_attachments()
+        more = False
+        for root, (max_bytes, max_days) in self.quotas.items():
+            if not os.path.isdir(root):
+                continue
+            if now - self.scanned.get(root, 0) >= STORAGE_SCAN_TIME:
+                added, dropped = self.catalog.sync(root)
+                self.scanned[root] = now
+                debug("Storage %s scanned: %d added, %d dropped" % (root, added, dropped))
+            budget = STORAGE_BATCH
+            for path in self.catalog.expired(root, now - max_days * 86400, budget, protected):
+                if self._delete(path):
+                    budget -= 1
+            count, size = self.catalog.usage(root)
+            for path, file_size in self.catalog.least_used(root, budget, protected):
+                if size <= max_bytes or budget <= 0:
+                    break
+                if self._delete(path):
+                    size -= file_size
+                    budget -= 1
+            more = more or budget <= 0
+        return more
+
+    def _run(self):
+        while not self.stopping:
+            try:
+                more = self.step()
+            except Exception:
+                debug(traceback.format_exc())
+                more = False
+            # Right away again while there is a backlog, but not all at once
+            self.wakeup.wait(1 if more else STORAGE_INTERVAL)
+            self.wakeup.clear()
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def media_catalog():
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = MediaCatalog()
+        return _catalog
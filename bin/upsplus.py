@@ -7,14 +7,151 @@
 # Author : Andrea Bravetti
 # ---------------------------------------------------------------
 
-import subprocess
+# GeeekPi UPS Plus:
+# https://wiki.52pi.com/index.php/UPS_Plus_SKU:_EP-0136
+#
+# The UPS registers are read straight from /dev/i2c-1 (no i2cget), all in
+# one I2C transaction, and cached for UPS_REFRESH seconds: the functions
+# below return the last sampled values.
+#
+# Registers of the UPS MCU at 0x17, 16 bit little endian words:
+#
+#   0x01 MCU voltage (mV)           0x13 battery remaining capacity (%)
+#   0x03 Pi output voltage (mV)     0x15 battery sampling period (min)
+#   0x05 battery voltage (mV)       0x17 power status (byte)
+#   0x07 USB-C input voltage (mV)   0x1C cumulative running time (s, 32 bit)
+#   0x09 micro USB input (mV)       0x20 cumulative charging time (s, 32 bit)
+#   0x0B battery temperature (C)    0x24 current running time (s, 32 bit)
+#   0x0D battery full voltage (mV)  0x28 firmware version
+#   0x0F battery empty voltage (mV)
+#   0x11 battery protection voltage (mV)
+#
+# The battery current comes from the INA219 at 0x45: shunt voltage in
+# register 0x01, big endian, 10uV per bit.
+
+import os
+import time
+import fcntl
+import ctypes
+import struct
+import threading
+from collections import namedtuple
+
+from utility import *
+from metrics import ups_seconds, ups_errors
+
+UPS_I2C_BUS = getattr(config, "UPS_I2C_BUS", "/dev/i2c-1")
+UPS_REFRESH = getattr(config, "UPS_REFRESH", 5)
+UPS_SHUNT_OHM = getattr(config, "UPS_SHUNT_OHM", 0.00725)
+
+UPS_ADDRESS = 0x17
+UPS_REGISTERS = 0x2A
+INA219_BATTERY = 0x45
+
+# linux/i2c-dev.h and linux/i2c.h
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+class _I2CMsg(ctypes.Structure):
+    _fields_ = [("addr", ctypes.c_uint16), ("flags", ctypes.c_uint16),
+                ("len", ctypes.c_uint16), ("buf", ctypes.POINTER(ctypes.c_uint8))]
+
+class _I2CRdwrData(ctypes.Structure):
+    _fields_ = [("msgs", ctypes.POINTER(_I2CMsg)), ("nmsgs", ctypes.c_uint32)]
+
+class I2CBus:
+    def __init__(self, path: str = UPS_I2C_BUS):
+        self.fd = os.open(path, os.O_RDWR)
+
+    def close(self):
+        os.close(self.fd)
+
+    def read_block(self, address: int, register: int, length: int):
+        # Write the register and read the data with a repeated start
+        write = (ctypes.c_uint8 * 1)(register)
+        read = (ctypes.c_uint8 * length)()
+        msgs = (_I2CMsg * 2)(
+            _I2CMsg(address, 0, 1, write),
+            _I2CMsg(address, I2C_M_RD, length, read),
+        )
+        fcntl.ioctl(self.fd, I2C_RDWR, _I2CRdwrData(msgs, 2))
+        return bytes(read)
+
+Telemetry = namedtuple("Telemetry", [
+    "time",
+    "mcu_voltage", "output_voltage", "battery_voltage", "usbc_voltage", "microusb_voltage",
+    "temperature", "full_voltage", "empty_voltage", "protection_voltage",
+    "battery_percentage", "sampling_period", "power_status",
+    "running_time", "charging_time", "current_running_time", "version",
+    "battery_current",
+])
+
+def parse_telemetry(now: float, data: bytes, shunt: bytes):
+    words = struct.unpack_from("<11H", data, 0x01)
+    times = struct.unpack_from("<3I", data, 0x1C)
+    version, = struct.unpack_from("<H", data, 0x28)
+    shunt_voltage, = struct.unpack(">h", shunt)
+    # mA: 10uV per bit over the shunt resistor
+    current = shunt_voltage * 0.01 / UPS_SHUNT_OHM
+    return Telemetry(now, *words, data[0x17], *times, version, current)
+
+class UPSSampler:
+    def __init__(self, bus = None, refresh: float = UPS_REFRESH):
+        self.bus = bus
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.telemetry = None
+        self.error = 0
+        self.sampled = 0
+
+    def _open(self):
+        if self.bus is None:
+            self.bus = I2CBus(UPS_I2C_BUS)
+        return self.bus
+
+    def sample(self):
+        now = time.time()
+        start = time.monotonic()
+        try:
+            bus = self._open()
+            data = bus.read_block(UPS_ADDRESS, 0x00, UPS_REGISTERS)
+            try:
+                shunt = bus.read_block(INA219_BATTERY, 0x01, 2)
+            except OSError:
+                # No current sensor, not worth an error
+                shunt = b"\0\0"
+            self.telemetry = parse_telemetry(now, data, shunt)
+            self.error = 0
+        except OSError as e:
+            debug("Error reading UPS: %s" % e)
+            self.telemetry = None
+            self.error = e.errno or 1
+            ups_errors.inc()
+        ups_seconds.observe(time.monotonic() - start)
+        self.sampled = now
+
+    def snapshot(self):
+        with self.lock:
+            if time.time() - self.sampled >= self.refresh:
+                self.sample()
+            return self.telemetry, self.error
+
+sampler = UPSSampler()
+
+def ups_telemetry():
+    return sampler.snapshot()
 
 def input_voltage():
-    # i2cget -y 1 0x17 0x07 w
-    result = subprocess.run(['i2cget', '-y', '1', '0x17', '0x07', 'w'], stdout=subprocess.PIPE)
-    return int(result.stdout, 0) if result.returncode==0 else 0, result.returncode
+    telemetry, error = sampler.snapshot()
+    return telemetry.usbc_voltage if telemetry is not None else 0, error
 
 def battery_percentage():
-    # i2cget -y 1 0x17 0x13 w
-    result = subprocess.run(['i2cget', '-y', '1', '0x17', '0x13', 'w'], stdout=subprocess.PIPE)
-    return int(result.stdout, 0) if result.returncode==0 else 0, result.returncode
+    telemetry, error = sampler.snapshot()
+    return telemetry.battery_percentage if telemetry is not None else 0, error
+
+if __name__ == "__main__":
+    telemetry, error = ups_telemetry()
+    if telemetry is None:
+        raise Exception("Error %d reading UPS" % error)
+    for name, value in telemetry._asdict().items():
+        print("%-20s %s" % (name, value))
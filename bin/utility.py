@@ -13,3 +13,22 @@ def debug(*args):
     if config.DEBUG:
         for msg in args:
             print(msg)
+
+def sd_notify(state: str):
+    # Tell systemd (Type=notify) about our state, e.g. "READY=1"; returns
+    # False when not started by systemd
+    import os, socket
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return False
+    if path.startswith("@"):
+        # Abstract namespace
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(path)
+            sock.sendall(state.encode())
+    except OSError as e:
+        debug("Error notifying systemd: %s" % e)
+        return False
+    return True